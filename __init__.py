@@ -4,9 +4,26 @@
 # Docs at https://github.com/AlexVerrico/CovidParser
 
 import json  # Used for loading and exporting data
+import os  # Used for atomically replacing snapshot files
+import sys  # Used for checking the byte order of snapshot files
+import mmap  # Used for sharing snapshot files between processes
+import socket  # Used for talking to the cache daemon
+import threading  # Used for rate limiting bulk downloads
+import heapq  # Used for picking the top locations in rank()
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor  # Used for bulk downloading and parsing
+from concurrent.futures.process import BrokenProcessPool  # Used for recovering from parse worker crashes
+import multiprocessing  # Used for starting parse workers without forking
+import struct  # Used for packing snapshot file headers
+import sqlite3  # Used for the history archive
+from array import array  # Used for packing integer columns in snapshot files
 import urllib.request  # Used to fetch data
-from time import time  # Used for the caching system
+import urllib.parse  # Used for finding the host of a URL for the circuit breakers
+from time import time, sleep, gmtime  # Used for the caching system
 from re import search as re_search, DOTALL  # Used for parsing data from epidemic-stats
+from re import compile as re_compile  # Used for finding the end of arrays in streamed pages
+from datetime import datetime, date  # Used for converting dates to and from day numbers
+from functools import lru_cache  # Used for caching parsed dates
+from contextlib import contextmanager  # Used for holding a scheduler slot while a response is read
 from typing import TypedDict  # Used for declaring a custom return type for functions
 
 # Standard output format used by all public functions of CovidParser
@@ -14,9 +31,444 @@ StandardReturnTypeV3 = TypedDict('StandardReturnTypeV3', {'status': str, 'conten
 # Required format for any CovidParser functions with the 'date_range' argument
 DateRangeTypeV3 = TypedDict('DateRangeTypeV3', {'type': str, 'value': str})
 
+# Snapshot file layout: magic, header length (uint32 little endian), JSON index, then 8 byte aligned columns
+SNAPSHOT_MAGIC_V3 = b'CPSNAP03'
+# Value stored in integer columns (of snapshots and TimeSeriesV3 objects) for entries that were empty or not a number
+MISSING_VALUE_V3 = -2 ** 63
+SNAPSHOT_MISSING_V3 = MISSING_VALUE_V3
+# Date formats used by the data sources, in the order they are tried
+DATE_FORMATS_V3 = ['%d/%m/%y', '%d/%m/%Y', '%Y-%m-%d']
+# Data types which are exported to snapshots (vaccinations-percent is a single value, not a series)
+SNAPSHOT_DATA_TYPES_V3 = ['cases', 'deaths', 'recoveries', 'vaccinations', 'vaccinations-firstdose']
+# Series which new() can't return with the 'all' date range (it raises IndexError for them), so they aren't exported
+BROKEN_SERIES_V3 = [('aus', 'recoveries')]
+# Seconds to wait for the cache daemon before falling back to fetching in-process
+CACHE_DAEMON_TIMEOUT_V3 = 60
+# Seconds to wait for a response from upstream before giving up
+UPSTREAM_TIMEOUT_V3 = 30
+# Number of failures in a row after which requests to a host fail fast, and for how many seconds
+CIRCUIT_BREAKER_THRESHOLD_V3 = 5
+CIRCUIT_BREAKER_COOLDOWN_V3 = 60
+# HTTP status codes below 500 which mean that upstream is unavailable (request timeout, too many requests)
+UPSTREAM_UNAVAILABLE_CODES_V3 = (408, 429)
+# Metrics supported by CovidParser.rank
+RANK_METRICS_V3 = ('sum', 'mean', 'growth', 'per_capita')
+# Estimated resident population of the Australian locations (ABS, June 2021), used for the per_capita metric
+POPULATIONS_V3 = {'aus': 25739256, 'nsw': 8189266, 'vic': 6649159, 'qld': 5221170, 'sa': 1781516, 'wa': 2681633,
+                  'tas': 541479, 'nt': 246143, 'act': 432266}
+# Refresh policies used with cache_type 3, matched by the start of each URL
+# ttl is the number of seconds to cache a URL for. Each refresh which returns unchanged data multiplies it by backoff,
+# up to max_ttl, and any change resets it. During a publish window ('HH:MM' to 'HH:MM' in UTC), when the source
+# usually updates, the window's (shorter) ttl is used instead
+REFRESH_POLICIES_V3 = {
+    # Main connector (cases and deaths), updated a few times a day, usually mid morning AEST
+    'https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20':
+        {'ttl': 1800, 'max_ttl': 7200, 'backoff': 2, 'windows': [('21:00', '03:00', 300)]},
+    # State recoveries, updated along with the main connector
+    'https://atlas.jifo.co/api/connectors/1806e38a-75e1-44b3-a9ed-fb384165cabf':
+        {'ttl': 1800, 'max_ttl': 7200, 'backoff': 2, 'windows': [('21:00', '03:00', 300)]},
+    # Vaccination connectors, updated once a day
+    'https://atlas.jifo.co/api/connectors/728c45eb-6045-4aa2-9bcc-9d2597424858':
+        {'ttl': 21600, 'max_ttl': 86400, 'backoff': 2, 'windows': [('00:00', '04:00', 900)]},
+    'https://atlas.jifo.co/api/connectors/ba5a3a2a-82ef-4225-b054-27227066c0c0':
+        {'ttl': 21600, 'max_ttl': 86400, 'backoff': 2, 'windows': [('00:00', '04:00', 900)]},
+    'https://atlas.jifo.co/api/connectors/08ca8032-69d9-40c1-9bfe-b5610e768295':
+        {'ttl': 21600, 'max_ttl': 86400, 'backoff': 2, 'windows': [('00:00', '04:00', 900)]},
+    'https://atlas.jifo.co/api/connectors/075c0786-674c-482b-91da-06fde61d025c':
+        {'ttl': 21600, 'max_ttl': 86400, 'backoff': 2, 'windows': [('00:00', '04:00', 900)]},
+    # Country pages, which update on their own schedule through the day
+    'https://epidemic-stats.com/': {'ttl': 3600, 'max_ttl': 14400, 'backoff': 2, 'windows': []}
+}
+# Priorities of upstream requests for FetchSchedulerV3, lower goes first
+# Foreground requests are the ones that a caller is waiting on, background ones are bulk or speculative refreshes
+PRIORITY_FOREGROUND_V3 = 0
+PRIORITY_BACKGROUND_V3 = 1
+# Regular expressions used to extract each data_type from an epidemic-stats page
+COUNTRY_REGEXES_V3 = {'cases': r"const infected_new = (\[.*?\])",
+                      'deaths': r"const deaths_new = (\[.*?\])",
+                      'recoveries': r"const recovered_new = (\[.*?\])"}
+# Markers of the arrays in an epidemic-stats page, which are all that is kept when streaming a page
+COUNTRY_MARKERS_V3 = ('const deaths_new = ', 'const infected_new = ', 'const recovered_new = ')
+# Key of the array of tables in a connector payload, and the whitespace allowed between JSON elements
+CONNECTOR_TABLES_KEY_V3 = 'data'
+JSON_WHITESPACE_V3 = re_compile(r'[ \t\n\r]*')
+# Number of bytes to read at a time when streaming a page
+STREAM_CHUNK_SIZE_V3 = 16384
+# Characters which matter when looking for the end of an array in a streamed page
+STREAM_TOKENS_V3 = re_compile(rb'[\[\]"\'\\]')
+
+
+# Function to read a page in chunks, keeping only the array which follows each of the markers
+# It stops reading (so the connection can be closed) as soon as the last array is complete
+# Returns each marker followed by its array on a separate line, which can be parsed in the same way as the full page
+def _stream_extract_v3(response, markers, chunk_size: int = STREAM_CHUNK_SIZE_V3) -> str:
+    remaining = [i.encode('utf-8') for i in markers]
+    # Number of bytes to keep between chunks while searching, in case a marker is split across two chunks
+    keep = max([len(i) for i in remaining]) - 1
+    found = {}
+    buffer = b''
+    marker = None
+    while len(remaining) > 0 or marker is not None:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            break
+        buffer = buffer + chunk
+        while True:
+            if marker is None:
+                # Look for whichever of the remaining markers comes first
+                best = None
+                for i in remaining:
+                    position = buffer.find(i)
+                    if position != -1 and (best is None or position < best[0]):
+                        best = (position, i)
+                if best is None:
+                    buffer = buffer[-keep:] if keep > 0 else b''
+                    break
+                marker = best[1]
+                remaining.remove(marker)
+                # From here on, the buffer only holds the array for this marker
+                buffer = buffer[best[0] + len(marker):]
+                scan_position = 0
+                array_start = None
+                depth = 0
+                quote = None
+                escaped_position = -1
+            end = None
+            for match in STREAM_TOKENS_V3.finditer(buffer, scan_position):
+                char = match.group()
+                position = match.start()
+                if quote is not None:
+                    # Inside a string only the closing quote matters, unless it has been escaped
+                    if char == b'\\' and position != escaped_position:
+                        escaped_position = position + 1
+                    elif char == quote and position != escaped_position:
+                        quote = None
+                elif array_start is None:
+                    if char == b'[':
+                        array_start = position
+                        depth = 1
+                elif char == b'"' or char == b"'":
+                    quote = char
+                elif char == b'[':
+                    depth = depth + 1
+                elif char == b']':
+                    depth = depth - 1
+                    if depth == 0:
+                        end = position + 1
+                        break
+            if end is None:
+                # The array continues in the next chunk
+                scan_position = len(buffer)
+                break
+            found[marker] = buffer[array_start:end]
+            buffer = buffer[end:]
+            marker = None
+            if len(remaining) == 0:
+                break
+    return ''.join([f"{i}{found[i.encode('utf-8')].decode('utf-8')}\n" for i in markers
+                    if i.encode('utf-8') in found])
+
+
+# Function to convert a date from the data sources to a day number (date ordinal), or 0 if it isn't a date
+@lru_cache(maxsize=4096)
+def _date_to_ordinal_v3(text: str) -> int:
+    for date_format in DATE_FORMATS_V3:
+        try:
+            return datetime.strptime(text, date_format).toordinal()
+        except ValueError:
+            continue
+    return 0
+
+
+# Function to normalise a location name for looking it up in the location index
+# Case, surrounding whitespace, punctuation and the choice of spaces, hyphens or underscores between words don't matter
+def _normalise_location_v3(location: str) -> str:
+    return '-'.join(location.lower().replace('_', ' ').replace('-', ' ').replace('.', '').replace("'", '').split())
+
+
+# Function to load the bundled index of epidemic-stats.com country slugs (locations.json), once per process
+# Returns a dictionary of {normalised slug, ISO code or alias: slug}
+@lru_cache(maxsize=1)
+def _location_index_v3() -> dict:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'locations.json')) as f:
+        countries = json.load(f)
+    index = {}
+    for slug in countries:
+        for name in [slug] + countries[slug]:
+            index[_normalise_location_v3(name)] = slug
+    return index
+
+
+# Function to check whether a time of day (in minutes since midnight) is within a publish window
+# The window may wrap around midnight, e.g. ('21:00', '03:00')
+def _in_window_v3(minute: int, start: str, end: str) -> bool:
+    start = int(start[:2]) * 60 + int(start[3:5])
+    end = int(end[:2]) * 60 + int(end[3:5])
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+
+# Function to work out the size in bytes of an object and everything inside it
+def _deep_size_v3(obj, seen: set = None) -> int:
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size = size + sum([_deep_size_v3(k, seen) + _deep_size_v3(v, seen) for k, v in obj.items()])
+    elif isinstance(obj, (list, tuple, set)):
+        size = size + sum([_deep_size_v3(i, seen) for i in obj])
+    return size
+
+
+# Function to parse the per day values for each of data_types out of an epidemic-stats page
+# This is a module level function rather than a method so that it can be run in a process pool
+def _parse_country_page_v3(page: str, data_types) -> dict:
+    out = {}
+    for data_type in data_types:
+        # Replace the single quotes with double quotes, and remove the trailing comma, so the array is valid JSON
+        data = re_search(COUNTRY_REGEXES_V3[data_type], page, DOTALL)[1].replace("'", '"')
+        out[data_type] = json.loads(_rreplace_v3(data, ',', '', 1))
+    return out
+
+
+# Function to replace X number of occurences of a string with
+# a different string, starting at the end of the input string
+def _rreplace_v3(s, old, _new, occurrence):
+    li = s.rsplit(old, occurrence)
+    return _new.join(li)
+
+
+# Function to work out a ranking metric over the last window days of a series of values (oldest first)
+# Returns None if the metric can't be worked out for the series
+def _rank_value_v3(values: list, metric: str, window: int, population: int = None):
+    current = values[-window:]
+    if len(current) == 0:
+        return None
+    if metric == 'sum':
+        return sum(current)
+    elif metric == 'mean':
+        return sum(current) / len(current)
+    elif metric == 'growth':
+        # Change compared to the window before, as a fraction of it
+        previous = values[-2 * window:-window]
+        if len(previous) < window or sum(previous) == 0:
+            return None
+        return (sum(current) - sum(previous)) / sum(previous)
+    elif metric == 'per_capita':
+        if population is None:
+            return None
+        # Per 100,000 people
+        return sum(current) * 100000 / population
+    return None
+
+
+# Read only list of the tables in a connector payload, which only decodes each table when it is first used
+# The tables are found in order, so a call only reads the payload up to the last table it uses. The starts of the
+# tables found so far and the decoded tables are kept in a parsed cache entry, until the payload is refreshed
+class ConnectorTablesV3:
+    __slots__ = ('text', 'entry')
+
+    def __init__(self, text: str, entry: dict):
+        self.text = text
+        self.entry = entry
+        if 'offsets' not in entry:
+            position = JSON_WHITESPACE_V3.match(text, self.__find_tables(text)).end()
+            # offsets is set last, so another thread which finds it always finds the rest of the entry too
+            entry['tables'] = {}
+            if text[position] == ']':
+                entry['count'] = 0
+                entry['offsets'] = []
+            else:
+                entry['offsets'] = [position]
+        return
+
+    def __len__(self):
+        while 'count' not in self.entry:
+            self.__decode(len(self.entry['offsets']) - 1)
+        return self.entry['count']
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index = index + len(self)
+        if index < 0:
+            raise IndexError('table index out of range')
+        tables = self.entry['tables']
+        if index not in tables:
+            # Pass over the tables before index which haven't been found yet, decoding each one only to find its end
+            while len(self.entry['offsets']) <= index:
+                if 'count' in self.entry:
+                    raise IndexError('table index out of range')
+                self.__decode(len(self.entry['offsets']) - 1)
+            tables[index] = self.__decode(index)
+        return tables[index]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # Function to find where the array of tables starts, which is the value of the "data" key of the top level object
+    # The values of any keys before it are passed over whole, so a "data" key nested inside one of them isn't used
+    @staticmethod
+    def __find_tables(text: str) -> int:
+        decoder = json.JSONDecoder()
+        position = JSON_WHITESPACE_V3.match(text).end()
+        if text[position:position + 1] != '{':
+            raise ValueError('Connector payload is not an object')
+        position = JSON_WHITESPACE_V3.match(text, position + 1).end()
+        while text[position:position + 1] == '"':
+            key, position = decoder.raw_decode(text, position)
+            position = JSON_WHITESPACE_V3.match(text, position).end()
+            if text[position:position + 1] != ':':
+                raise ValueError(f'Expected \':\' at {position} in connector payload')
+            position = JSON_WHITESPACE_V3.match(text, position + 1).end()
+            if key == CONNECTOR_TABLES_KEY_V3 and text[position:position + 1] == '[':
+                return position + 1
+            _, position = decoder.raw_decode(text, position)
+            position = JSON_WHITESPACE_V3.match(text, position).end()
+            if text[position:position + 1] == ',':
+                position = JSON_WHITESPACE_V3.match(text, position + 1).end()
+        raise ValueError('No data array in connector payload')
+
+    # Function to decode the table at index, and if it is the last one found so far, record where the next one starts
+    # The offsets are replaced rather than appended to, so threads finding the same table can't record it twice
+    def __decode(self, index: int):
+        offsets = self.entry['offsets']
+        table, position = json.JSONDecoder().raw_decode(self.text, offsets[index])
+        if index == len(offsets) - 1:
+            position = JSON_WHITESPACE_V3.match(self.text, position).end()
+            if self.text[position] == ',':
+                self.entry['offsets'] = offsets + [JSON_WHITESPACE_V3.match(self.text, position + 1).end()]
+            elif self.text[position] == ']':
+                self.entry['count'] = len(offsets)
+            else:
+                raise ValueError(f'Unexpected {self.text[position]!r} at {position} in connector payload')
+        return table
+
+
+# Raised when data can't be fetched from upstream because of a timeout, a deadline or an open circuit breaker
+# It is a URLError so that existing handlers for network errors still catch it
+class UpstreamUnavailableV3(urllib.error.URLError):
+    pass
+
+
+# Wrapper around an upstream response which reads the body in chunks, checking the deadline before each one
+# The timeout only limits each read from the socket, so without this a slow body could run well past the deadline
+class _DeadlineResponseV3:
+    def __init__(self, response, url: str, deadline: float):
+        self.response = response
+        self.url = url
+        self.deadline = deadline
+
+    def read(self, size: int = -1) -> bytes:
+        if size is not None and size >= 0:
+            self.check()
+            return self.response.read(size)
+        chunks = []
+        while True:
+            self.check()
+            chunk = self.response.read(STREAM_CHUNK_SIZE_V3)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    # Raises UpstreamUnavailableV3 once the deadline has passed
+    def check(self):
+        if self.deadline - time() <= 0:
+            raise UpstreamUnavailableV3(f'Deadline passed while reading {self.url}')
+
+
+# Scheduler which every upstream request waits on before it is sent, to keep within a budget of requests per second
+# (a token bucket holding up to burst requests) and a limit on the number of requests to each host at once
+# Waiting requests go in order of priority and then arrival, so requests which callers are waiting on go before
+# background ones. Share one scheduler between CovidParser objects (with scheduler=) to give them one budget
+class FetchSchedulerV3:
+    def __init__(self, rate: float = None, burst: int = 1, host_limits: dict = None, default_host_limit: int = None):
+        # Requests per second, or None for no limit, and the number of requests which can be sent at once
+        self.rate = rate
+        self.burst = max(1, int(burst))
+        # Dictionary of {host: maximum requests at once}, with default_host_limit for every other host
+        self.host_limits = {} if host_limits is None else host_limits
+        self.default_host_limit = default_host_limit
+        self.tokens = float(self.burst)
+        self.updated = time()
+        # Number of requests in progress to each host, and the waiting requests as (priority, arrival, host)
+        self.active = {}
+        self.waiting = []
+        self.arrivals = 0
+        # Number of requests sent at each priority, and the total number of seconds spent waiting
+        self.stats = {'requests': {PRIORITY_FOREGROUND_V3: 0, PRIORITY_BACKGROUND_V3: 0}, 'wait_seconds': 0.0}
+        self.condition = threading.Condition()
+        return
+
+    # Function to add the tokens earned since the last update to the bucket
+    def __refill(self):
+        now = time()
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return
+
+    def __host_free(self, host):
+        limit = self.host_limits.get(host, self.default_host_limit)
+        return limit is None or self.active.get(host, 0) < limit
+
+    # Function to wait until a request to host can be sent, raising UpstreamUnavailableV3 if deadline passes first
+    # Every call must be followed by a call to release() once the response has been read
+    def acquire(self, host: str, priority: int = PRIORITY_FOREGROUND_V3, deadline: float = None):
+        with self.condition:
+            self.arrivals = self.arrivals + 1
+            ticket = (priority, self.arrivals, host)
+            self.waiting.append(ticket)
+            start = time()
+            try:
+                while True:
+                    self.__refill()
+                    # The first waiting request whose host has a free slot goes next
+                    first = min([i for i in self.waiting if self.__host_free(i[2])], default=None)
+                    if first == ticket and (self.rate is None or self.tokens >= 1):
+                        break
+                    # Wait until there is a token, or until another request is sent or released
+                    wait = (1 - self.tokens) / self.rate if first == ticket else None
+                    if deadline is not None:
+                        if deadline - time() <= 0:
+                            raise UpstreamUnavailableV3(f'Deadline passed while waiting to fetch from {host}')
+                        wait = deadline - time() if wait is None else min(wait, deadline - time())
+                    self.condition.wait(wait)
+            finally:
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+            if self.rate is not None:
+                self.tokens = self.tokens - 1
+            self.active[host] = self.active.get(host, 0) + 1
+            self.stats['requests'][priority] = self.stats['requests'].get(priority, 0) + 1
+            self.stats['wait_seconds'] = self.stats['wait_seconds'] + time() - start
+        return
+
+    def release(self, host: str):
+        with self.condition:
+            self.active[host] = self.active[host] - 1
+            self.condition.notify_all()
+        return
+
 
 class CovidParser:
-    def __init__(self, cache_type=0, cache_update_interval=0, log_file=None):
+    # Caches shared by every CovidParser object created with shared_cache=True, keyed by the cache configuration
+    _shared_caches_v3 = {}
+    _shared_caches_lock_v3 = threading.Lock()
+    # Process pools shared by every fetch_countries() call, keyed by the number of workers, created when first used
+    _parse_pools_v3 = {}
+    _parse_pools_lock_v3 = threading.Lock()
+
+    def __init__(self, cache_type=0, cache_update_interval=0, log_file=None, cache_socket=None, shared_cache=False,
+                 timeout=UPSTREAM_TIMEOUT_V3, circuit_breaker_threshold=CIRCUIT_BREAKER_THRESHOLD_V3,
+                 circuit_breaker_cooldown=CIRCUIT_BREAKER_COOLDOWN_V3, upstream_overrides=None,
+                 refresh_policies=None, strict_locations=False, scheduler=None, archive_path=None):
         # Set the cache type, with a default to fallback to
         try:
             self.cache_type = int(cache_type)
@@ -28,6 +480,12 @@ class CovidParser:
         except ValueError:
             self.cache_update_interval = 5
 
+        # Refresh policies for cache_type 3, with any given policies replacing the defaults for the same URLs
+        self.refresh_policies = {**REFRESH_POLICIES_V3, **({} if refresh_policies is None else refresh_policies)}
+
+        # If True, then locations which aren't in the location index are rejected instead of being looked up upstream
+        self.strict_locations = strict_locations
+
         # Set the self.print variable to point to the correct function
         if log_file is None:
             self.print = print
@@ -36,84 +494,69 @@ class CovidParser:
             # Store the log file location
             self.log_file = log_file
 
-        # Dictionary to store cached data in with an example entry
-        self.data_cache_v3 = {
-            'example': {  # URL
-                'timestamp': int(str(time()).split('.')[0]),  # Timestamp of when it was last downloaded
-                'uses': 0,  # Number of uses since it was last downloaded
-                'data': 'json data'  # Data
-            }
-        }
+        # Unix socket of a cache daemon (see cache_daemon.py) to fetch data through, or None to fetch in-process
+        self.cache_socket = cache_socket
 
-        # Dictionary of locations, their appropriate functions, and various other data
-        self.__locations_v3 = {'aus': {'new_function': self.__get_aus_new_v3},
-                               'nsw': {
-                                   # Function to call for per day new cases|deaths|recoveries
-                                   'new_function': self.__get_state_new_v3,
-                                   'new_cases_index': 1,  # Index required for part of __get_state_new_v3
-                                   'new_deaths_index': 1,  # Index required for part of __get_state_new_v3
-                                   'new_recoveries_index': 1,  # Index required for part of __get_state_new_v3
-                                   'new_vaccinations_index': 1,  # Index required for part of __get_state_new_v3
-                                   'vaccinations_percent_index': 0  # Index required for part of __get_state_new_v3
-                               },
-                               'vic': {'new_function': self.__get_state_new_v3,
-                                       'new_cases_index': 2,
-                                       'new_deaths_index': 2,
-                                       'new_recoveries_index': 2,
-                                       'new_vaccinations_index': 2,
-                                       'vaccinations_percent_index': 1},
-                               'qld': {'new_function': self.__get_state_new_v3,
-                                       'new_cases_index': 3,
-                                       'new_deaths_index': 3,
-                                       'new_recoveries_index': 3,
-                                       'new_vaccinations_index': 3,
-                                       'vaccinations_percent_index': 2},
-                               'sa': {'new_function': self.__get_state_new_v3,
-                                      'new_cases_index': 4,
-                                      'new_deaths_index': 4,
-                                      'new_recoveries_index': 4,
-                                      'new_vaccinations_index': 4,
-                                      'vaccinations_percent_index': 3},
-                               'wa': {'new_function': self.__get_state_new_v3,
-                                      'new_cases_index': 5,
-                                      'new_deaths_index': 5,
-                                      'new_recoveries_index': 5,
-                                      'new_vaccinations_index': 5,
-                                      'vaccinations_percent_index': 4},
-                               'tas': {'new_function': self.__get_state_new_v3,
-                                       'new_cases_index': 6,
-                                       'new_deaths_index': 6,
-                                       'new_recoveries_index': 6,
-                                       'new_vaccinations_index': 6,
-                                       'vaccinations_percent_index': 5},
-                               'nt': {'new_function': self.__get_state_new_v3,
-                                      'new_cases_index': 7,
-                                      'new_deaths_index': 7,
-                                      'new_recoveries_index': 7,
-                                      'new_vaccinations_index': 7,
-                                      'vaccinations_percent_index': 6},
-                               'act': {'new_function': self.__get_state_new_v3,
-                                       'new_cases_index': 8,
-                                       'new_deaths_index': 8,
-                                       'new_recoveries_index': 8,
-                                       'new_vaccinations_index': 8,
-                                       'vaccinations_percent_index': 7}
-                               }
-
-        # Mapping of long/full location names to their corresponding names in self.__locations_v3
-        self.__locations_long_v3 = {'australia': 'aus',
-                                    'new south wales': 'nsw',
-                                    'victoria': 'vic',
-                                    'queensland': 'qld',
-                                    'south australia': 'sa',
-                                    'western australia': 'wa',
-                                    'tasmania': 'tas',
-                                    'northern territory': 'nt',
-                                    'australian capital territory': 'act',
-                                    'america': 'usa'
-                                    }
+        # Seconds to wait for upstream, and the circuit breaker settings
+        self.timeout = timeout
+        self.circuit_breaker_threshold = circuit_breaker_threshold
+        self.circuit_breaker_cooldown = circuit_breaker_cooldown
+        # Dictionary of {'https://upstream.host': 'http://replacement:port'} for fetching from somewhere else,
+        # e.g. a simulated upstream (the cache still uses the original URLs)
+        self.upstream_overrides = {} if upstream_overrides is None else upstream_overrides
+        # FetchSchedulerV3 which every upstream request waits on, or None to send requests straight away
+        self.scheduler = scheduler
+        # HistoryArchiveV3 which records the rows of every refresh, for new(..., as_of=...), or None
+        self.archive = None if archive_path is None else HistoryArchiveV3(archive_path)
+        # Deadline of the current call, and whether it used stale data, for each thread
+        self.__call_state_v3 = threading.local()
+        # Dictionary of {(location, data_type): {'callbacks': [...], 'rows': {...}}} for subscribe()
+        self.subscriptions_v3 = {}
+
+        # If the cache is shared, then use the process wide cache for this configuration, creating it if needed
+        if shared_cache is True:
+            with CovidParser._shared_caches_lock_v3:
+                key = (self.cache_type, self.cache_update_interval)
+                if self.cache_type == 3:
+                    key = key + (json.dumps(self.refresh_policies, sort_keys=True),)
+                shared = CovidParser._shared_caches_v3.setdefault(key, self.__new_cache_v3())
+            self.data_cache_v3 = shared['data']
+            self.parsed_cache_v3 = shared['parsed']
+            self.circuit_breakers_v3 = shared['circuit_breakers']
+            self.cache_stats_v3 = shared['stats']
+            self.rank_cache_v3 = shared['ranks']
+        else:
+            cache = self.__new_cache_v3()
+            self.data_cache_v3 = cache['data']
+            self.parsed_cache_v3 = cache['parsed']
+            self.circuit_breakers_v3 = cache['circuit_breakers']
+            self.cache_stats_v3 = cache['stats']
+            self.rank_cache_v3 = cache['ranks']
         return
 
+    # Function to create an empty set of caches
+    @staticmethod
+    def __new_cache_v3():
+        return {
+            # Dictionary to store cached data in with an example entry
+            'data': {
+                'example': {  # URL
+                    'timestamp': int(str(time()).split('.')[0]),  # Timestamp of when it was last downloaded
+                    'uses': 0,  # Number of uses since it was last downloaded
+                    'data': 'json data'  # Data
+                }
+            },
+            # Dictionary to store parsed data in, keyed by URL
+            # Each entry holds the data it was parsed from, so it is only used while the same data is still cached
+            'parsed': {},
+            # Dictionary of {'failures': int, 'open_until': timestamp} for each host
+            'circuit_breakers': {},
+            # Number of requests answered from the cache (hits) and by fetching (misses)
+            'stats': {'hits': 0, 'misses': 0},
+            # Dictionary of rank() results, each with the cache entries it was worked out from
+            'ranks': {}
+        }
+
     # Basic function to append output to a file
     def __log(self, data):
         # Open the file in append mode
@@ -122,55 +565,390 @@ class CovidParser:
             f.write(f'{data}\n\n')
         return
 
-    # Function to replace X number of occurences of a string with
-    # a different string, starting at the end of the input string
-    def __rreplace(self, s, old, _new, occurrence):
-        li = s.rsplit(old, occurrence)
-        return _new.join(li)
-
     # Function to store the data for a URL in the cache and set uses and timestamp for the entry
-    def __update_cache_v3(self, url):
-        # Check if the URL is cached, and if not create an empty entry in the cache
-        try:
-            self.data_cache_v3[url]
-        except KeyError:
-            self.data_cache_v3[url] = {}
-        # Set the uses to 0 and the timestamp to the current time for the entry in the cache
-        self.data_cache_v3[url]['uses'] = 0
-        self.data_cache_v3[url]['timestamp'] = int(str(time()).split('.')[0])
-        # Fetch the url and store the response in the cache
-        with urllib.request.urlopen(url) as response:
-            self.data_cache_v3[url]['data'] = response.read().decode('utf-8')
+    # If markers is set, then only the arrays following the markers are kept (see _stream_extract_v3)
+    def __update_cache_v3(self, url, markers=None):
+        # Set the uses to 0 and the timestamp to the current time for the new entry
+        entry = {'uses': 0, 'timestamp': int(str(time()).split('.')[0])}
+        # Fetch the url and store the response in the entry
+        with self.__open_upstream_v3(url) as response:
+            if markers is None:
+                entry['data'] = response.read().decode('utf-8')
+            else:
+                entry['data'] = _stream_extract_v3(response, markers)
+                entry['partial'] = markers
+        self.__store_entry_v3(url, entry)
         # Return the updated data
-        return self.data_cache_v3[url]['data']
+        return entry['data']
+
+    # Function to store a new entry in the cache, and tell any subscribers about changes to the data
+    def __store_entry_v3(self, url, entry):
+        previous = self.data_cache_v3.get(url, {}).get('data')
+        if self.cache_type == 3:
+            policy = self.__refresh_policy_v3(url)
+            # Back off while the data stays the same, and go back to the normal ttl as soon as it changes
+            if entry['data'] == previous:
+                entry['ttl'] = min(self.data_cache_v3[url].get('ttl', policy['ttl']) * policy.get('backoff', 1),
+                                   policy.get('max_ttl', policy['ttl']))
+            else:
+                entry['ttl'] = policy['ttl']
+        # Replace the entry in the cache in one step, as the cache may be shared with other threads
+        self.data_cache_v3[url] = entry
+        if self.archive is not None and entry['data'] != previous:
+            self.__archive_v3(url)
+        if len(self.subscriptions_v3) > 0 and entry['data'] != previous:
+            self.__notify_subscribers_v3(url)
+        return
+
+    # Function to record the rows of every series which comes from url in the archive
+    def __archive_v3(self, url):
+        if url.startswith('https://epidemic-stats.com/'):
+            series = [(url[len('https://epidemic-stats.com/coronavirus/'):], i) for i in COUNTRY_REGEXES_V3]
+        else:
+            # Only series which can be read from the tables (which leaves out BROKEN_SERIES_V3)
+            series = [(i, j) for i in self.__locations_v3 for j in SNAPSHOT_DATA_TYPES_V3
+                      if self.__source_url_v3(i, j) == url and self.__series_table_v3(i, j) is not None]
+        rows = {}
+        for location, data_type in series:
+            try:
+                rows[(location, data_type)] = self.__cached_rows_v3(location, data_type)
+            except (KeyError, IndexError, TypeError, ValueError, urllib.error.URLError) as e:
+                self.print(f"Failed to archive {location} {data_type} in CovidParser.__archive_v3 ({repr(e)})")
+        try:
+            self.archive.record(url, rows)
+        except sqlite3.Error as e:
+            self.print(f"Failed to archive {url} in CovidParser.__archive_v3 ({repr(e)})")
+        return
+
+    # Function to turn a location into the name it is stored under, so all aliases of a location share cache entries
+    # Returns None for unknown locations when strict_locations is set, and the location unchanged otherwise
+    def __resolve_location_v3(self, location):
+        location = location.lower()
+        if location in self.__locations_long_v3:
+            return self.__locations_long_v3[location]
+        if location in self.__locations_v3 or location == 'all-states':
+            return location
+        slug = _location_index_v3().get(_normalise_location_v3(location))
+        if slug is not None:
+            return slug
+        if self.strict_locations is True:
+            return None
+        return location
+
+    # Function to return the refresh policy for a URL (the policy with the longest matching prefix)
+    # URLs without a policy are cached for cache_update_interval seconds
+    def __refresh_policy_v3(self, url):
+        prefixes = [i for i in self.refresh_policies if url.startswith(i)]
+        if len(prefixes) == 0:
+            return {'ttl': self.cache_update_interval, 'windows': []}
+        return self.refresh_policies[max(prefixes, key=len)]
+
+    # Function to work out how many seconds a cached entry for a URL is fresh for, according to its refresh policy
+    def __policy_ttl_v3(self, url, entry):
+        policy = self.__refresh_policy_v3(url)
+        now = gmtime()
+        for start, end, ttl in policy.get('windows', []):
+            if _in_window_v3(now.tm_hour * 60 + now.tm_min, start, end):
+                return min(ttl, entry.get('ttl', policy['ttl']))
+        return entry.get('ttl', policy['ttl'])
+
+    # Function to return where the rows of a series are in its connector, as (table, column, cumulative)
+    # cumulative is True for series whose per day values are the differences between running totals in the table
+    # Returns None for anything which isn't a series of per day rows (such as vaccinations-percent, or countries)
+    def __series_table_v3(self, location, data_type):
+        if location not in self.__locations_v3 or (location, data_type) in BROKEN_SERIES_V3:
+            return None
+        if location == 'aus':
+            columns = {'cases': (3, 1, False), 'deaths': (11, 1, False), 'vaccinations': (0, 2, True),
+                       'vaccinations-seconddose': (0, 2, True), 'vaccinations-firstdose': (0, 1, True)}
+            return columns.get(data_type)
+        index = self.__locations_v3[location]
+        if data_type in ('cases', 'deaths'):
+            return 7 if data_type == 'cases' else 16, index[f'new_{data_type}_index'], False
+        if data_type == 'recoveries':
+            return index['new_recoveries_index'], 3, True
+        # new() reads the second dose table for every state vaccinations data_type
+        if data_type in ('vaccinations', 'vaccinations-seconddose', 'vaccinations-firstdose'):
+            return 0, index['new_vaccinations_index'], True
+        return None
+
+    # Function to generate the (date, value) rows of a series straight from the decoded tables, oldest first
+    # The values are the ones new() returns with the 'all' date range. Rows without a date are skipped
+    # tables can be the already downloaded tables of the series' connector
+    def __series_rows_v3(self, location, data_type, tables=None):
+        table, column, cumulative = self.__series_table_v3(location, data_type)
+        if tables is None:
+            tables = self.__tables_v3(self.__source_url_v3(location, data_type))
+        table = tables[table]
+        # The first row of each table is its header, and the first day of a running total has no previous day
+        for i in range(2 if cumulative else 1, len(table)):
+            if table[i][0] == "" or table[i][0] == " ":
+                continue
+            if cumulative is False:
+                yield table[i][0], table[i][column]
+                continue
+            try:
+                yield table[i][0], str(int(table[i][column]) - int(table[i - 1][column]))
+            except ValueError:
+                yield table[i][0], ''
+
+    # Function to return the rows of a series as a dictionary, using only cached data (for subscribers and the archive)
+    # The keys are the dates, or for epidemic-stats locations (which have no dates) the number of the day
+    def __cached_rows_v3(self, location, data_type):
+        if self.__source_url_v3(location, data_type).startswith('https://epidemic-stats.com/'):
+            entry = self.data_cache_v3.get(self.__source_url_v3(location, data_type))
+            if entry is None:
+                return {}
+            return dict(enumerate(_parse_country_page_v3(entry['data'], [data_type])[data_type]))
+        self.__call_state_v3.cached_only = True
+        try:
+            # Series of per day rows are read straight from the decoded tables, and anything else through _new_v3
+            if self.__series_table_v3(location, data_type) is not None:
+                return dict(self.__series_rows_v3(location, data_type))
+            out = self._new_v3(location=location, data_type=data_type, date_range={'type': 'all'}, include_date=True)
+        finally:
+            self.__call_state_v3.cached_only = False
+        if out['status'] != 'ok':
+            return {}
+        return {row[0]: row[1] for row in json.loads(out['content']) if isinstance(row, list) and len(row) > 1}
+
+    # Function to call the subscribers of every series which comes from url, if its rows have been added or revised
+    def __notify_subscribers_v3(self, url):
+        for key in list(self.subscriptions_v3):
+            location, data_type = key
+            if self.__source_url_v3(location, data_type) != url:
+                continue
+            subscription = self.subscriptions_v3[key]
+            try:
+                rows = self.__cached_rows_v3(location, data_type)
+            except (KeyError, IndexError, TypeError, ValueError, urllib.error.URLError) as e:
+                self.print(f"Failed to check {location} {data_type} for subscribers ({repr(e)})")
+                continue
+            previous = subscription['rows']
+            changes = {
+                'added': [[i, rows[i]] for i in rows if i not in previous],
+                'revised': [[i, previous[i], rows[i]] for i in rows if i in previous and previous[i] != rows[i]]
+            }
+            subscription['rows'] = rows
+            if len(changes['added']) == 0 and len(changes['revised']) == 0:
+                continue
+            for callback in list(subscription['callbacks']):
+                try:
+                    callback(location, data_type, changes)
+                except Exception as e:
+                    self.print(f"Subscriber for {location} {data_type} raised {repr(e)}")
+        return
+
+    # Function to return the URL that the data for a location and data_type comes from
+    def __source_url_v3(self, location, data_type):
+        if location not in self.__locations_v3:
+            return r'https://epidemic-stats.com/coronavirus/{country}'.format(country=location)
+        if data_type.startswith('vaccinations-percent'):
+            if location == 'aus':
+                return r'https://atlas.jifo.co/api/connectors/08ca8032-69d9-40c1-9bfe-b5610e768295'
+            return r'https://atlas.jifo.co/api/connectors/728c45eb-6045-4aa2-9bcc-9d2597424858'
+        if data_type.startswith('vaccinations'):
+            if location == 'aus':
+                return r'https://atlas.jifo.co/api/connectors/075c0786-674c-482b-91da-06fde61d025c'
+            return r'https://atlas.jifo.co/api/connectors/ba5a3a2a-82ef-4225-b054-27227066c0c0'
+        if data_type == 'recoveries' and location != 'aus':
+            return r'https://atlas.jifo.co/api/connectors/1806e38a-75e1-44b3-a9ed-fb384165cabf'
+        return r'https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20'
+
+    # Function to open a URL upstream, using the timeout, the deadline of the current call, and the circuit breakers
+    # Raises UpstreamUnavailableV3 if the host's circuit breaker is open, the deadline has passed, or the request fails
+    @contextmanager
+    def __open_upstream_v3(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        breaker = self.circuit_breakers_v3.setdefault(host, {'failures': 0, 'open_until': 0})
+        if breaker['open_until'] > time():
+            raise UpstreamUnavailableV3(f'Circuit breaker open for {host}')
+        for i in self.upstream_overrides:
+            if url.startswith(i):
+                url = self.upstream_overrides[i] + url[len(i):]
+                break
+        deadline = getattr(self.__call_state_v3, 'deadline', None)
+        if deadline is not None and deadline - time() <= 0:
+            raise UpstreamUnavailableV3(f'Deadline passed before fetching {url}')
+        # Bulk downloads can pace themselves, so that only the requests which actually go upstream wait
+        pace = getattr(self.__call_state_v3, 'pace', None)
+        if pace is not None:
+            pace()
+        # Wait for the scheduler, which holds a slot for the host until the response has been read
+        if self.scheduler is not None:
+            self.scheduler.acquire(host, getattr(self.__call_state_v3, 'priority', PRIORITY_FOREGROUND_V3), deadline)
+        try:
+            timeout = self.timeout
+            if deadline is not None:
+                if deadline - time() <= 0:
+                    raise UpstreamUnavailableV3(f'Deadline passed before fetching {url}')
+                timeout = deadline - time() if timeout is None else min(timeout, deadline - time())
+            try:
+                response = urllib.request.urlopen(url, timeout=timeout)
+            except urllib.error.HTTPError as e:
+                # Client errors (e.g. unknown countries) are normal and are passed on as they are, but server errors,
+                # timeouts and rate limiting mean that upstream is unavailable, and count towards the circuit breaker
+                if e.code < 500 and e.code not in UPSTREAM_UNAVAILABLE_CODES_V3:
+                    raise
+                self.__record_failure_v3(host, breaker)
+                raise UpstreamUnavailableV3(f'Failed to fetch {url} ({repr(e)})')
+            except (OSError, ValueError) as e:
+                self.__record_failure_v3(host, breaker)
+                raise UpstreamUnavailableV3(f'Failed to fetch {url} ({repr(e)})')
+            with response:
+                try:
+                    yield response if deadline is None else _DeadlineResponseV3(response, url, deadline)
+                except OSError as e:
+                    # Reading the body failed (e.g. upstream stalled after sending the headers)
+                    if isinstance(e, UpstreamUnavailableV3):
+                        raise
+                    self.__record_failure_v3(host, breaker)
+                    raise UpstreamUnavailableV3(f'Failed to read {url} ({repr(e)})')
+            breaker['failures'] = 0
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.release(host)
+
+    def __record_failure_v3(self, host, breaker):
+        breaker['failures'] = breaker['failures'] + 1
+        if breaker['failures'] >= self.circuit_breaker_threshold:
+            self.print(f"Opening circuit breaker for {host} for {self.circuit_breaker_cooldown} seconds")
+            breaker['open_until'] = time() + self.circuit_breaker_cooldown
+            breaker['failures'] = 0
+        return
+
+    # Function to update an entry in the cache, falling back to the cached data (flagged as stale) if upstream fails
+    def __refresh_v3(self, url, markers=None):
+        self.cache_stats_v3['misses'] = self.cache_stats_v3['misses'] + 1
+        try:
+            return self.__update_cache_v3(url, markers)
+        except UpstreamUnavailableV3 as e:
+            entry = self.data_cache_v3.get(url)
+            if entry is None or 'data' not in entry or entry.get('partial', markers) != markers:
+                raise
+            self.print(f"Serving stale data for {url} ({e.reason})")
+            self.__call_state_v3.stale = True
+            return entry['data']
+
+    # Function to run a query with an optional deadline (in seconds)
+    # If the query had to use stale data, then the output is flagged with 'stale': True
+    def __run_query_v3(self, query, deadline=None):
+        self.__call_state_v3.deadline = None if deadline is None else time() + deadline
+        self.__call_state_v3.stale = False
+        try:
+            out = query()
+        except UpstreamUnavailableV3 as e:
+            self.print(f"Upstream unavailable in CovidParser ({e.reason})")
+            out = {
+                'status': 'error',
+                'content': 'Upstream unavailable',
+                'classified': 0
+            }
+        finally:
+            self.__call_state_v3.deadline = None
+        if self.__call_state_v3.stale is True:
+            out['stale'] = True
+        return out
+
+    # Function to fetch a URL through the cache daemon
+    # A local copy of each URL is kept, and the daemon only sends the data again if its version has changed
+    # Raises OSError if the daemon can't be reached, so the caller can fall back to fetching in-process, and
+    # UpstreamUnavailableV3 if the daemon couldn't fetch the URL (and there is no local copy to use instead)
+    def __daemon_fetch_v3(self, url):
+        entry = self.data_cache_v3.get(url)
+        version = None if entry is None else entry.get('version')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CACHE_DAEMON_TIMEOUT_V3)
+            sock.connect(self.cache_socket)
+            sock.sendall((f'{url}\n' if version is None else f'{url} {version}\n').encode('utf-8'))
+            with sock.makefile('rb') as response:
+                # The daemon replies with a "<status> <value> [<version>]" line, followed by the data for ok and
+                # error replies, or "notmodified <version>" if the local copy is still current
+                reply = response.readline().decode('utf-8').split()
+                status, value = reply[0], reply[1]
+                if status == 'httperror':
+                    raise urllib.error.HTTPError(url, int(value), 'HTTP Error from cache daemon', None, None)
+                if status == 'notmodified' and version is not None:
+                    entry['uses'] = entry['uses'] + 1
+                    self.cache_stats_v3['hits'] = self.cache_stats_v3['hits'] + 1
+                    return entry['data']
+                data = response.read(int(value))
+                if len(data) != int(value):
+                    raise ConnectionError('Truncated reply from cache daemon')
+        if status == 'error':
+            if entry is None or 'data' not in entry or 'partial' in entry:
+                raise UpstreamUnavailableV3(f'Cache daemon failed to fetch {url} ({data.decode("utf-8")})')
+            self.print(f"Serving stale data for {url} (cache daemon failed to fetch it: {data.decode('utf-8')})")
+            self.__call_state_v3.stale = True
+            return entry['data']
+        if status != 'ok':
+            raise ConnectionError(f'Unexpected reply from cache daemon: {status}')
+        self.cache_stats_v3['misses'] = self.cache_stats_v3['misses'] + 1
+        entry = {
+            'uses': 1,
+            'timestamp': int(str(time()).split('.')[0]),
+            'data': data.decode('utf-8'),
+            'version': reply[2] if len(reply) > 2 else None
+        }
+        # The daemon only sends the data when its version has changed, so store it like any other update, which
+        # records it in the archive and tells the subscribers about it
+        self.__store_entry_v3(url, entry)
+        return entry['data']
 
     # Function to check whether an entry in the cache needs to be updated
     # If it does, it will update it then return the data, otherwise it will return the cached data
-    def __download_data_v3(self, url):
-        # Check if the URL is in the cache
-        if url in self.data_cache_v3:
+    # If markers is set, then an entry holding only the arrays following the markers is good enough
+    # If force is set, then the cached entry is always updated (the cache daemon still decides for its own cache)
+    def __download_data_v3(self, url, markers=None, force=False):
+        # While checking for changes for subscribers, only the data which has just been cached is used
+        if getattr(self.__call_state_v3, 'cached_only', False) is True and url in self.data_cache_v3:
+            return self.data_cache_v3[url]['data']
+        # If there is a cache daemon, then it owns the caching, and we only fall back to our own cache without it
+        if self.cache_socket is not None:
+            try:
+                return self.__daemon_fetch_v3(url)
+            except (OSError, ValueError) as e:
+                # Errors from upstream (passed on by the daemon) are raised, only a failure to talk to it falls back
+                if isinstance(e, urllib.error.URLError):
+                    raise
+                self.print(f"Cache daemon unavailable in CovidParser.__download_data_v3, fetching in-process ({repr(e)})")
+        if force is True:
+            return self.__refresh_v3(url, markers)
+        # Check if the URL is in the cache (and that the entry isn't missing anything that we need)
+        if url in self.data_cache_v3 and self.data_cache_v3[url].get('partial', markers) == markers:
             # If the we aren't truly caching the URL, then update the cache and return the result
             if self.cache_type == 0:
-                return self.__update_cache_v3(url)
+                return self.__refresh_v3(url, markers)
             # If we are caching based on number of uses
             elif self.cache_type == 1:
                 # Check if the cache needs to be updated, and return the appropriate data
                 if self.data_cache_v3[url]['uses'] >= self.cache_update_interval:
-                    return self.__update_cache_v3(url)
+                    return self.__refresh_v3(url, markers)
                 else:
                     self.data_cache_v3[url]['uses'] = self.data_cache_v3[url]['uses'] + 1
+                    self.cache_stats_v3['hits'] = self.cache_stats_v3['hits'] + 1
                     return self.data_cache_v3[url]['data']
             # If we are caching based on time since last update
             elif self.cache_type == 2:
                 # Check if the cache needs to be updated, and return the appropriate data
                 if (int(str(time()).split('.')[0]) - self.data_cache_v3[url]['timestamp']) > self.cache_update_interval:
-                    return self.__update_cache_v3(url)
+                    return self.__refresh_v3(url, markers)
                 else:
                     self.data_cache_v3[url]['uses'] = self.data_cache_v3[url]['uses'] + 1
+                    self.cache_stats_v3['hits'] = self.cache_stats_v3['hits'] + 1
                     return self.data_cache_v3[url]['data']
+            # If we are caching based on the refresh policy of each URL
+            elif self.cache_type == 3:
+                entry = self.data_cache_v3[url]
+                if (int(str(time()).split('.')[0]) - entry['timestamp']) > self.__policy_ttl_v3(url, entry):
+                    return self.__refresh_v3(url, markers)
+                else:
+                    entry['uses'] = entry['uses'] + 1
+                    self.cache_stats_v3['hits'] = self.cache_stats_v3['hits'] + 1
+                    return entry['data']
         # If the URL isn't in the cache, then we return the output of __update_cache_v3
         else:
-            return self.__update_cache_v3(url)
+            return self.__refresh_v3(url, markers)
 
     # Function to retrieve and parse data for any Australian state
     def __get_state_new_v3(self, data_type: str = 'cases', date_range: DateRangeTypeV3 = None,
@@ -217,8 +995,7 @@ class CovidParser:
         # If the requested data_type is cases
         if data_type == 'cases':
             # Get the correct data and load it
-            data = self.__download_data_v3(r'https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20')
-            data = json.loads(data)['data'][7]
+            data = self.__tables_v3(r'https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20')[7]
             # If the date_range is in days, call __get_state_new_v3_iter_func
             if date_range['type'] == 'days':
                 out = __get_state_new_v3_iter_func(data, date_range['value'],
@@ -250,8 +1027,7 @@ class CovidParser:
             return out_full
 
         elif data_type == 'deaths':
-            data = self.__download_data_v3(r'https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20')
-            data = json.loads(data)['data'][16]
+            data = self.__tables_v3(r'https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20')[16]
             if date_range['type'] == 'days':
                 out = __get_state_new_v3_iter_func(data, date_range['value'],
                                                    self.__locations_v3[location]['new_deaths_index'], include_date)
@@ -282,8 +1058,7 @@ class CovidParser:
         elif data_type == 'recoveries':
             out = []
             # Get the correct data and load it
-            data = self.__download_data_v3(r'https://atlas.jifo.co/api/connectors/1806e38a-75e1-44b3-a9ed-fb384165cabf')
-            data = json.loads(data)['data']
+            data = self.__tables_v3(r'https://atlas.jifo.co/api/connectors/1806e38a-75e1-44b3-a9ed-fb384165cabf')
             # If the call requested more values that what are available, return the maximum available
             if date_range['type'] == 'days':
                 if date_range['value'] > len(data[self.__locations_v3[location]['new_recoveries_index']]) - 1:
@@ -367,8 +1142,7 @@ class CovidParser:
 
         elif data_type.startswith('vaccinations'):
             if data_type.startswith('vaccinations-percent'):
-                data = self.__download_data_v3(r'https://atlas.jifo.co/api/connectors/728c45eb-6045-4aa2-9bcc-9d2597424858')
-                data = json.loads(data)['data']
+                data = self.__tables_v3(r'https://atlas.jifo.co/api/connectors/728c45eb-6045-4aa2-9bcc-9d2597424858')
                 if data_type == 'vaccinations-percent-over16-seconddose':
                     vaccine_type = 0
                 elif data_type == 'vaccinations-percent-over16-firstdose':
@@ -390,13 +1164,13 @@ class CovidParser:
             else:
                 out = []
                 # Get the correct data and load it
-                data = self.__download_data_v3(r'https://atlas.jifo.co/api/connectors/ba5a3a2a-82ef-4225-b054-27227066c0c0')
+                data = self.__tables_v3(r'https://atlas.jifo.co/api/connectors/ba5a3a2a-82ef-4225-b054-27227066c0c0')
                 if data_type == 'vaccinations' or data_type == 'vaccinations-seconddose':
-                    data = json.loads(data)['data'][0]
+                    data = data[0]
                 elif data_type == 'vaccinations-firstdvose':
-                    data = json.loads(data)['data'][2]
+                    data = data[2]
                 else:
-                    data = json.loads(data)['data'][0]
+                    data = data[0]
                 # If the call requested more values that what are available, return the maximum available
                 if date_range['type'] == 'days':
                     if date_range['value'] > len(data) - 1:
@@ -492,8 +1266,7 @@ class CovidParser:
         }
         if data_type == 'cases':
             out = []
-            data = self.__download_data_v3(r'https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20')
-            data = json.loads(data)['data']
+            data = self.__tables_v3(r'https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20')
             if date_range['type'] == 'days':
                 if date_range['value'] > len(data[3]) - 1:
                     date_range['value'] = len(data[3]) - 1
@@ -528,8 +1301,7 @@ class CovidParser:
             return out_full
         elif data_type == 'deaths':
             out = []
-            data = self.__download_data_v3(r'https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20')
-            data = json.loads(data)['data']
+            data = self.__tables_v3(r'https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20')
             if date_range['type'] == 'days':
                 if date_range['value'] > len(data[11]) - 1:
                     date_range['value'] = len(data[11]) - 1
@@ -562,8 +1334,7 @@ class CovidParser:
             return out_full
         elif data_type == 'recoveries':
             out = []
-            data = self.__download_data_v3(r'https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20')
-            data = json.loads(data)['data']
+            data = self.__tables_v3(r'https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20')
             data = data[43]
             if date_range['type'] == 'days':
                 if date_range['value'] > len(data) - 1:
@@ -596,8 +1367,7 @@ class CovidParser:
 
         elif data_type.startswith('vaccinations'):
             if data_type.startswith('vaccinations-percent'):
-                data = self.__download_data_v3(r'https://atlas.jifo.co/api/connectors/08ca8032-69d9-40c1-9bfe-b5610e768295')
-                data = json.loads(data)['data']
+                data = self.__tables_v3(r'https://atlas.jifo.co/api/connectors/08ca8032-69d9-40c1-9bfe-b5610e768295')
                 if data_type.startswith('vaccinations-percent-over16'):
                     vaccine_age = 0
                 elif data_type.startswith('vaccinations-percent-over12'):
@@ -620,8 +1390,7 @@ class CovidParser:
 
             else:
                 out = []
-                data = self.__download_data_v3(r'https://atlas.jifo.co/api/connectors/075c0786-674c-482b-91da-06fde61d025c')
-                data = json.loads(data)['data'][0]
+                data = self.__tables_v3(r'https://atlas.jifo.co/api/connectors/075c0786-674c-482b-91da-06fde61d025c')[0]
                 if data_type == 'vaccinations' or data_type == 'vaccinations-seconddose':
                     vaccine_type = 2
                 elif data_type == 'vaccinations-firstdose':
@@ -670,26 +1439,41 @@ class CovidParser:
             out_full['content'] = 'Unsupported data_type'
             return out_full
 
+    # Function to download a connector and return the tables in its payload, decoding each one only when it is used
+    def __tables_v3(self, url):
+        data = self.__download_data_v3(url)
+        parsed = self.parsed_cache_v3.get(url)
+        # Only index the payload if it hasn't already been indexed since it was downloaded
+        if parsed is None or parsed['data'] is not data:
+            parsed = {'data': data}
+            self.parsed_cache_v3[url] = parsed
+        return ConnectorTablesV3(data, parsed)
+
+    # Function to return the parsed per day values of data_type from the downloaded page (data) of a country
+    def __parse_country_v3(self, country, data_type, data):
+        url = r'https://epidemic-stats.com/coronavirus/{country}'.format(country=country)
+        parsed = self.parsed_cache_v3.get(url)
+        # Only parse the page if it hasn't already been parsed since it was downloaded
+        if parsed is None or parsed['data'] is not data:
+            parsed = {'data': data}
+            self.parsed_cache_v3[url] = parsed
+        if data_type not in parsed:
+            parsed.update(_parse_country_page_v3(data, [data_type]))
+        return parsed[data_type]
+
     def __get_country_new_v3(self, data_type: str = 'cases', date_range: DateRangeTypeV3 = None,
                              include_date: bool = False, location: str = 'australia') -> StandardReturnTypeV3:
         if date_range is None:
             date_range = {'type': 'days', 'value': 2}
         data = self.__download_data_v3(r'https://epidemic-stats.com/coronavirus/{country}'
-                                       .format(country=location.lower()))
+                                       .format(country=location.lower()), markers=COUNTRY_MARKERS_V3)
         out_full = {
             'status': 'ok',
             'content': '',
             'classified': 0
         }
-        if data_type == 'cases':
-            regex = ".+const infected_new = (.+)const recovered_new = .+"
-            data = json.loads(self.__rreplace(re_search(regex, data, DOTALL)[1].replace("'", '"'), ',', '', 1))
-        elif data_type == 'deaths':
-            regex = ".+const deaths_new = (.+)const infected_new = .+"
-            data = json.loads(self.__rreplace(re_search(regex, data, DOTALL)[1].replace("'", '"'), ',', '', 1))
-        elif data_type == 'recoveries':
-            regex = ".+const recovered_new = (.+)const current_infected = .+"
-            data = json.loads(self.__rreplace(re_search(regex, data, DOTALL)[1].replace("'", '"'), ',', '', 1))
+        if data_type in COUNTRY_REGEXES_V3:
+            data = self.__parse_country_v3(location.lower(), data_type, data)
         else:
             self.print(f"Unsupported data_type in CovidParser.__get_country_new_v3(data_type={data_type}")
             out_full['status'] = 'error'
@@ -712,6 +1496,61 @@ class CovidParser:
         out_full['content'] = json.dumps(out)
         return out_full
 
+    # Function to retrieve the per day new cases|deaths for every state at once, from a single pass over the data
+    # The content is {'locations': [...], 'dates': [...], 'values': [[...], ...]}, with one row of values per date
+    def _new_matrix_v3(self, data_type: str = 'cases', date_range: DateRangeTypeV3 = None,
+                       include_national: bool = False) -> StandardReturnTypeV3:
+        if date_range is None:
+            date_range = {'type': 'days', 'value': 2}
+        out_full = {
+            'status': 'ok',
+            'content': '',
+            'classified': 0
+        }
+        # Index of the per state table, and of the national table, for each supported data_type
+        if data_type == 'cases':
+            state_table, national_table, index_name = 7, 3, 'new_cases_index'
+        elif data_type == 'deaths':
+            state_table, national_table, index_name = 16, 11, 'new_deaths_index'
+        else:
+            self.print(f"Unsupported data_type in CovidParser._new_matrix_v3(data_type={data_type})")
+            out_full['status'] = 'error'
+            out_full['content'] = 'Unsupported data_type'
+            return out_full
+        if date_range['type'] == 'days':
+            max_rows = int(date_range['value'])
+        elif date_range['type'] == 'all':
+            max_rows = None
+        else:
+            self.print(f"Unsupported date_range type in CovidParser._new_matrix_v3(date_range={date_range})")
+            out_full['status'] = 'error'
+            out_full['content'] = 'Unsupported date_range'
+            return out_full
+
+        data = self.__tables_v3(r'https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20')
+        locations = [i for i in self.__locations_v3 if index_name in self.__locations_v3[i]]
+        indexes = [self.__locations_v3[i][index_name] for i in locations]
+        national = {}
+        if include_national is True:
+            national = {row[0]: row[1] for row in data[national_table][1:] if len(row) > 1}
+            locations = ['aus'] + locations
+
+        dates = []
+        values = []
+        # Walk the table once from the newest entry, skipping the header row and any empty entries
+        for row in reversed(data[state_table][1:]):
+            if max_rows is not None and len(dates) >= max_rows:
+                break
+            if row[0] == "" or row[0] == " ":
+                continue
+            dates.append(row[0])
+            if include_national is True:
+                values.append([national.get(row[0], '')] + [row[i] for i in indexes])
+            else:
+                values.append([row[i] for i in indexes])
+        out_full['content'] = json.dumps({'locations': locations, 'dates': dates, 'values': values})
+        return out_full
+
     def _new_v3(self, location: str = 'aus', data_type: str = 'cases', date_range: DateRangeTypeV3 = None,
                 include_date: bool = False) -> StandardReturnTypeV3:
         if date_range is None:
@@ -721,11 +1560,16 @@ class CovidParser:
             'content': '',
             'classified': 0
         }
-        if location in self.__locations_long_v3:
-            location = self.__locations_long_v3[location]
+        location = self.__resolve_location_v3(location)
+        if location is None:
+            out_full['status'] = 'error'
+            out_full['content'] = "Unrecognised location"
+            return out_full
+        if location == 'all-states':
+            return self._new_matrix_v3(data_type=data_type, date_range=date_range)
         if location in self.__locations_v3:
             out = self.__locations_v3[location]['new_function'](
-                data_type=data_type, date_range=date_range, include_date=include_date, location=location)
+                self, data_type=data_type, date_range=date_range, include_date=include_date, location=location)
             if out['classified'] == 0:
                 return out
             elif out['classified'] == 1:
@@ -767,11 +1611,29 @@ class CovidParser:
             'content': '',
             'classified': 0
         }
-        if location in self.__locations_long_v3:
-            location = self.__locations_long_v3[location]
+        location = self.__resolve_location_v3(location)
+        if location is None:
+            out_full['status'] = 'error'
+            out_full['content'] = "Unrecognised location"
+            return out_full
+        # The total for each state, from the same single pass over the data as new() uses for all-states
+        if location == 'all-states':
+            out = self._new_matrix_v3(data_type=data_type, date_range=date_range)
+            if out['status'] != 'ok':
+                return out
+            matrix = json.loads(out['content'])
+            totals = {i: 0 for i in matrix['locations']}
+            for row in matrix['values']:
+                for i, value in zip(matrix['locations'], row):
+                    try:
+                        totals[i] = totals[i] + int(value)
+                    except (TypeError, ValueError):
+                        continue
+            out_full['content'] = json.dumps(totals)
+            return out_full
         if location in self.__locations_v3:
             out = self.__locations_v3[location]['new_function'](
-                data_type=data_type, date_range=date_range, include_date=False, location=location)
+                self, data_type=data_type, date_range=date_range, include_date=False, location=location)
 
             if out['classified'] == 1:
                 self.print(out)
@@ -827,14 +1689,989 @@ class CovidParser:
                 out_full['classified'] = 0
                 return out_full
 
+    def _rank_v3(self, data_type: str = 'cases', metric: str = 'sum', window: int = 7, locations: list = None,
+                 top: int = None) -> StandardReturnTypeV3:
+        out_full = {
+            'status': 'ok',
+            'content': '',
+            'classified': 0
+        }
+        if metric not in RANK_METRICS_V3:
+            self.print(f"Unsupported metric in CovidParser._rank_v3(metric={metric})")
+            out_full['status'] = 'error'
+            out_full['content'] = 'Unsupported metric'
+            return out_full
+        window = int(window)
+        if window < 1:
+            self.print(f"Unsupported window in CovidParser._rank_v3(window={window})")
+            out_full['status'] = 'error'
+            out_full['content'] = 'Unsupported window'
+            return out_full
+        # By default, rank the Australian locations and every country which is in the cache
+        if locations is None:
+            prefix = r'https://epidemic-stats.com/coronavirus/'
+            locations = list(self.__locations_v3) + [i[len(prefix):] for i in list(self.data_cache_v3)
+                                                      if i.startswith(prefix)]
+        else:
+            locations = [self.__resolve_location_v3(i) for i in locations]
+        locations = list(dict.fromkeys([i for i in locations if i is not None and i != 'all-states']))
+
+        # Bring the source of every location up to date, leaving out any locations whose source is unavailable
+        sources = {}
+        for location in locations:
+            url = self.__source_url_v3(location, data_type)
+            if url in sources:
+                continue
+            try:
+                markers = None if location in self.__locations_v3 else COUNTRY_MARKERS_V3
+                self.__download_data_v3(url, markers=markers)
+                sources[url] = self.data_cache_v3.get(url)
+            except urllib.error.URLError as e:
+                self.print(f"Failed to download {url} in CovidParser._rank_v3 ({repr(e)})")
+                sources[url] = None
+        locations = [i for i in locations if sources[self.__source_url_v3(i, data_type)] is not None]
+
+        # Reuse the last result for the same arguments, as long as none of its sources have been refreshed since
+        key = (data_type, metric, window, tuple(locations), top)
+        cached = self.rank_cache_v3.get(key)
+        if cached is not None and all([self.data_cache_v3.get(url) is entry for url, entry in cached['sources']]):
+            out_full['content'] = cached['content']
+            return out_full
+
+        # Per day values of every location, oldest first
+        series = {}
+        date_range = {'type': 'days', 'value': 2 * window}
+        states = [i for i in locations if i in self.__locations_v3]
+        if data_type in ('cases', 'deaths') and len(states) > 0:
+            # All the Australian locations come from one table, so read it in one go
+            out = self._new_matrix_v3(data_type=data_type, date_range=date_range, include_national=True)
+            if out['status'] == 'ok':
+                matrix = json.loads(out['content'])
+                for column, location in enumerate(matrix['locations']):
+                    series[location] = [row[column] for row in reversed(matrix['values'])]
+        for location in locations:
+            if location in series:
+                continue
+            if location in self.__locations_v3:
+                out = self._new_v3(location=location, data_type=data_type, date_range=date_range)
+                if out['status'] == 'ok' and isinstance(json.loads(out['content']), list):
+                    series[location] = list(reversed(json.loads(out['content'])))
+            elif data_type in COUNTRY_REGEXES_V3:
+                url = self.__source_url_v3(location, data_type)
+                try:
+                    series[location] = self.__parse_country_v3(location, data_type, sources[url]['data'])
+                except (KeyError, TypeError, ValueError) as e:
+                    self.print(f"Failed to parse {location} in CovidParser._rank_v3 ({repr(e)})")
+
+        values = []
+        for location in locations:
+            if location not in series:
+                continue
+            numbers = []
+            for i in series[location]:
+                try:
+                    numbers.append(int(i))
+                except (TypeError, ValueError):
+                    continue
+            value = _rank_value_v3(numbers, metric, window, POPULATIONS_V3.get(location))
+            if value is not None:
+                values.append([location, value])
+        # Only the top entries are needed, so pick them out rather than sorting everything
+        if top is not None:
+            values = heapq.nlargest(int(top), values, key=lambda i: i[1])
+        else:
+            values.sort(key=lambda i: i[1], reverse=True)
+        out_full['content'] = json.dumps(values)
+        self.rank_cache_v3[key] = {'sources': list(sources.items()), 'content': out_full['content']}
+        return out_full
+
+    # Function to generate (location, data_type, date, value) for every row of every series, oldest first
+    # Each source is downloaded once up front (sources which fail are logged and skipped), and the rows are generated
+    # from its tables without building the full output
+    # If since is set (in any of DATE_FORMATS_V3), only rows for later dates are generated. Rows for epidemic-stats
+    # locations have no dates, so since can't be used with them (ValueError)
+    def _export_rows_v3(self, locations: list = None, data_types: list = None, since: str = None):
+        if locations is None:
+            locations = list(self.__locations_v3)
+        if data_types is None:
+            data_types = SNAPSHOT_DATA_TYPES_V3
+        since = 0 if since is None else _date_to_ordinal_v3(since)
+        locations = [i for i in dict.fromkeys([self.__resolve_location_v3(i) for i in locations])
+                     if i is not None and i != 'all-states']
+        data_types = [i.lower() for i in data_types]
+        countries = [i for i in locations if i not in self.__locations_v3]
+        if since != 0 and len(countries) > 0:
+            raise ValueError(f"since can't be used with locations without dates ({', '.join(countries)})")
+        sources = {}
+        for url in dict.fromkeys([self.__source_url_v3(i, j) for i in locations for j in data_types]):
+            try:
+                if url.startswith('https://epidemic-stats.com/'):
+                    sources[url] = self.__download_data_v3(url, markers=COUNTRY_MARKERS_V3)
+                else:
+                    sources[url] = self.__tables_v3(url)
+            except (urllib.error.URLError, ValueError) as e:
+                self.print(f"Failed to download {url} in CovidParser._export_rows_v3 ({repr(e)})")
+        return self.__export_rows_v3(locations, data_types, since, sources)
+
+    # Function to generate the rows for _export_rows_v3 from the downloaded sources
+    def __export_rows_v3(self, locations, data_types, since, sources):
+        for location in locations:
+            for data_type in data_types:
+                url = self.__source_url_v3(location, data_type)
+                if url not in sources:
+                    continue
+                try:
+                    if location not in self.__locations_v3:
+                        if data_type not in COUNTRY_REGEXES_V3:
+                            continue
+                        for value in self.__parse_country_v3(location, data_type, sources[url]):
+                            yield location, data_type, '', value
+                        continue
+                    if self.__series_table_v3(location, data_type) is None:
+                        continue
+                    for day, value in self.__series_rows_v3(location, data_type, sources[url]):
+                        if since == 0 or _date_to_ordinal_v3(day) > since:
+                            yield location, data_type, day, value
+                except (KeyError, IndexError, TypeError, ValueError) as e:
+                    self.print(f"Skipping {location} {data_type} in CovidParser._export_rows_v3 ({repr(e)})")
+
+    # Function to return the rows of a series as they were at as_of (a timestamp, or a date meaning the end of that
+    # day in UTC), from the archive rather than upstream
+    def _new_as_of_v3(self, location: str = 'aus', data_type: str = 'cases', date_range: DateRangeTypeV3 = None,
+                      include_date: bool = False, as_of=None) -> StandardReturnTypeV3:
+        if date_range is None:
+            date_range = {'type': 'days', 'value': 2}
+        out_full = {
+            'status': 'ok',
+            'content': '',
+            'classified': 0
+        }
+        if self.archive is None:
+            out_full['status'] = 'error'
+            out_full['content'] = 'No archive'
+            return out_full
+        if isinstance(as_of, str):
+            if _date_to_ordinal_v3(as_of) == 0:
+                self.print(f"Unsupported as_of in CovidParser._new_as_of_v3(as_of={as_of})")
+                out_full['status'] = 'error'
+                out_full['content'] = 'Unsupported as_of'
+                return out_full
+            # Seconds since the epoch at the end of the day
+            as_of = (_date_to_ordinal_v3(as_of) - date(1970, 1, 1).toordinal() + 1) * 86400 - 1
+        location = self.__resolve_location_v3(location)
+        if location is None:
+            out_full['status'] = 'error'
+            out_full['content'] = "Unrecognised location"
+            return out_full
+        rows = self.archive.series(self.__source_url_v3(location, data_type), location, data_type, as_of)
+        if len(rows) == 0:
+            out_full['status'] = 'error'
+            out_full['content'] = 'Not in archive'
+            return out_full
+        if date_range['type'] == 'days':
+            rows = rows[max(len(rows) - int(date_range['value']), 0):]
+        elif date_range['type'] != 'all':
+            self.print(f"Unsupported date_range type in CovidParser._new_as_of_v3(date_range={date_range})")
+            out_full['status'] = 'error'
+            out_full['content'] = 'Unsupported date_range'
+            return out_full
+        # Newest first, like new(), and without dates for epidemic-stats locations which don't have them
+        if include_date is True and location in self.__locations_v3:
+            out_full['content'] = json.dumps([[day, value] for day, value in reversed(rows)])
+        else:
+            out_full['content'] = json.dumps([value for day, value in reversed(rows)])
+        return out_full
+
     def _fetch_data_v3(self, url: str) -> str:
         return self.__download_data_v3(url)
 
+    # Function to fetch only the arrays following each of the markers in a page (see _stream_extract_v3)
+    def _fetch_section_v3(self, url: str, markers) -> str:
+        return self.__download_data_v3(url, markers=tuple(markers))
+
+    # Function to call callback(location, data_type, changes) whenever a refresh adds or revises rows of a series
+    # changes is {'added': [[date, value], ...], 'revised': [[date, old value, new value], ...]}, where the date
+    # is the number of the day for epidemic-stats locations
+    # Only refreshes made by this object are checked, see refresh_subscriptions()
+    def subscribe(self, location: str, data_type: str, callback) -> StandardReturnTypeV3:
+        out_full = {
+            'status': 'ok',
+            'content': '',
+            'classified': 0
+        }
+        location = self.__resolve_location_v3(location)
+        data_type = data_type.lower()
+        if location is None:
+            out_full['status'] = 'error'
+            out_full['content'] = 'Unrecognised location'
+            return out_full
+        # Only series of per day rows can be checked for changes
+        if location in self.__locations_v3:
+            supported = self.__series_table_v3(location, data_type) is not None
+        else:
+            supported = data_type in COUNTRY_REGEXES_V3
+        if supported is False:
+            out_full['status'] = 'error'
+            out_full['content'] = 'Unsupported data_type'
+            return out_full
+        key = (location, data_type)
+        if key not in self.subscriptions_v3:
+            # Start from the current rows, so that the first refresh only reports what has changed since now
+            def __subscribe_rows():
+                url = self.__source_url_v3(location, data_type)
+                if url.startswith('https://epidemic-stats.com/'):
+                    self.__download_data_v3(url, markers=COUNTRY_MARKERS_V3)
+                return {'status': 'ok', 'content': self.__cached_rows_v3(location, data_type), 'classified': 0}
+
+            try:
+                out = self.__run_query_v3(__subscribe_rows)
+            except urllib.error.HTTPError:
+                out_full['status'] = 'error'
+                out_full['content'] = 'Unrecognised location'
+                return out_full
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                self.print(f"Failed to load {location} {data_type} in CovidParser.subscribe ({repr(e)})")
+                out = {'status': 'ok', 'content': {}, 'classified': 0}
+            # Without the current rows the first refresh would report every row as added, so don't subscribe yet
+            if out['status'] != 'ok':
+                return out
+            self.subscriptions_v3[key] = {'callbacks': [], 'rows': out['content']}
+        self.subscriptions_v3[key]['callbacks'].append(callback)
+        return out_full
+
+    def unsubscribe(self, location: str, data_type: str, callback) -> StandardReturnTypeV3:
+        out_full = {
+            'status': 'ok',
+            'content': '',
+            'classified': 0
+        }
+        location = self.__resolve_location_v3(location)
+        data_type = data_type.lower()
+        subscription = self.subscriptions_v3.get((location, data_type))
+        if subscription is None or callback not in subscription['callbacks']:
+            out_full['status'] = 'error'
+            out_full['content'] = 'Not subscribed'
+            return out_full
+        subscription['callbacks'].remove(callback)
+        if len(subscription['callbacks']) == 0:
+            del self.subscriptions_v3[(location, data_type)]
+        return out_full
+
+    # Function to refresh every source that has subscribers, calling the subscribers of anything that changed
+    # Call this on a timer (e.g. every minute) instead of polling new() for changes
+    def refresh_subscriptions(self) -> StandardReturnTypeV3:
+        out_full = {
+            'status': 'ok',
+            'content': '',
+            'classified': 0
+        }
+        results = {}
+        for location, data_type in list(self.subscriptions_v3):
+            url = self.__source_url_v3(location, data_type)
+            if url in results:
+                continue
+            markers = COUNTRY_MARKERS_V3 if url.startswith('https://epidemic-stats.com/') else None
+            # Refreshes for subscribers are background requests, as nobody is waiting on them
+            self.__call_state_v3.priority = PRIORITY_BACKGROUND_V3
+            self.__call_state_v3.stale = False
+            try:
+                # Any new version of the data (from upstream or the cache daemon) is stored through
+                # __store_entry_v3, which calls the subscribers
+                self.__download_data_v3(url, markers, force=True)
+                results[url] = 'Upstream unavailable' if self.__call_state_v3.stale is True else 'ok'
+            except urllib.error.URLError as e:
+                self.print(f"Failed to refresh {url} in CovidParser.refresh_subscriptions ({repr(e)})")
+                results[url] = 'Upstream unavailable'
+            finally:
+                self.__call_state_v3.priority = PRIORITY_FOREGROUND_V3
+                self.__call_state_v3.stale = False
+        out_full['content'] = json.dumps(results)
+        return out_full
+
+    # Function to report how much memory the cache is using, in bytes
+    # The content is a JSON object with the size of the raw data and the parsed data for each cached URL,
+    # and the totals for the whole cache
+    def memory_report(self) -> StandardReturnTypeV3:
+        out_full = {
+            'status': 'ok',
+            'content': '',
+            'classified': 0
+        }
+        entries = {}
+        totals = {'entries': 0, 'data_bytes': 0, 'parsed_bytes': 0, 'total_bytes': 0}
+        now = time()
+        for url in list(self.data_cache_v3):
+            entry = self.data_cache_v3[url]
+            parsed = self.parsed_cache_v3.get(url)
+            # Parsed data only counts if it belongs to the data which is currently cached
+            if parsed is not None and parsed['data'] is entry.get('data'):
+                parsed_bytes = sum([_deep_size_v3(parsed[i]) for i in parsed if i != 'data'])
+            else:
+                parsed_bytes = 0
+            data_bytes = sys.getsizeof(entry.get('data', ''))
+            entries[url] = {
+                'data_bytes': data_bytes,
+                'parsed_bytes': parsed_bytes,
+                'partial': 'partial' in entry,
+                'uses': entry.get('uses', 0),
+                'age': int(now - entry.get('timestamp', now))
+            }
+            totals['entries'] = totals['entries'] + 1
+            totals['data_bytes'] = totals['data_bytes'] + data_bytes
+            totals['parsed_bytes'] = totals['parsed_bytes'] + parsed_bytes
+        totals['total_bytes'] = totals['data_bytes'] + totals['parsed_bytes']
+        out_full['content'] = json.dumps({'entries': entries, 'totals': totals})
+        return out_full
+
+    # Function to return the shared process pool with parse_workers workers (the number of CPUs if None)
+    # Workers are started with forkserver (or spawn where that isn't available), as forking a process which is
+    # running threads (such as the download pool) can leave locks held in the child
+    def __parse_pool_v3(self, parse_workers):
+        with CovidParser._parse_pools_lock_v3:
+            pool = CovidParser._parse_pools_v3.get(parse_workers)
+            if pool is None:
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                pool = ProcessPoolExecutor(max_workers=parse_workers, mp_context=context)
+                CovidParser._parse_pools_v3[parse_workers] = pool
+            return pool
+
+    # Function to forget a shared process pool which has broken, so that the next call starts a new one
+    def __discard_parse_pool_v3(self, parse_workers, pool):
+        with CovidParser._parse_pools_lock_v3:
+            if CovidParser._parse_pools_v3.get(parse_workers) is pool:
+                del CovidParser._parse_pools_v3[parse_workers]
+        pool.shutdown(wait=False)
+        return
+
+    # Function to download and parse the pages for many countries at once, and load them all into the cache
+    # Pages are downloaded by up to max_concurrency threads, starting at most rate_limit downloads per second,
+    # and parsed by a pool of parse_workers processes so the parsing doesn't hold up the downloads
+    # The content is a JSON object of {country: 'ok' or an error message}
+    def fetch_countries(self, countries: list, data_types: list = None, max_concurrency: int = 8,
+                        rate_limit: float = None, parse_workers: int = None) -> StandardReturnTypeV3:
+        if data_types is None:
+            data_types = list(COUNTRY_REGEXES_V3)
+        out_full = {
+            'status': 'ok',
+            'content': '',
+            'classified': 0
+        }
+        for data_type in data_types:
+            if data_type not in COUNTRY_REGEXES_V3:
+                self.print(f"Unsupported data_type in CovidParser.fetch_countries(data_types={data_types})")
+                out_full['status'] = 'error'
+                out_full['content'] = 'Unsupported data_type'
+                return out_full
+        # Resolve the countries to their slugs, so that aliases of the same country are only downloaded once
+        names = list(dict.fromkeys([i.lower() for i in countries]))
+        slugs = {name: self.__resolve_location_v3(name) for name in names}
+        # The Australian locations come from the connectors rather than epidemic-stats, so they aren't downloaded
+        countries = list(dict.fromkeys([slugs[name] for name in names
+                                        if slugs[name] is not None and slugs[name] not in self.__locations_v3]))
+        results = {None: 'Unrecognised location', **{i: 'Unsupported location' for i in self.__locations_v3}}
+        pages = {}
+        parsed = {}
+        # Time at which the next download is allowed to start, when rate limiting
+        next_start = [time()]
+        rate_lock = threading.Lock()
+
+        # Function to wait for the rate limit, which is only called for pages which are downloaded from upstream
+        def __fetch_countries_pace():
+            with rate_lock:
+                wait = next_start[0] - time()
+                next_start[0] = max(next_start[0], time()) + 1 / rate_limit
+            if wait > 0:
+                sleep(wait)
+
+        # Function to get a page through the cache, so pages which are still fresh (in our cache or the cache
+        # daemon's) aren't downloaded again
+        def __fetch_countries_download(country):
+            # Bulk downloads give way to requests which callers are waiting on
+            self.__call_state_v3.priority = PRIORITY_BACKGROUND_V3
+            self.__call_state_v3.pace = __fetch_countries_pace if rate_limit else None
+            try:
+                return self.__download_data_v3(r'https://epidemic-stats.com/coronavirus/{country}'
+                                               .format(country=country), markers=COUNTRY_MARKERS_V3)
+            finally:
+                self.__call_state_v3.priority = PRIORITY_FOREGROUND_V3
+                self.__call_state_v3.pace = None
+
+        try:
+            parse_pool = self.__parse_pool_v3(parse_workers)
+        except (OSError, NotImplementedError, ValueError) as e:
+            # Some platforms can't start processes, in which case we parse in this process instead
+            self.print(f"No process pool in CovidParser.fetch_countries, parsing in-process ({repr(e)})")
+            parse_pool = None
+
+        # Function to parse a page in the process pool, or in this process if there isn't one or it has broken
+        def __fetch_countries_parse(country):
+            # Pages which came from the cache may have been parsed already
+            parsed_entry = self.parsed_cache_v3.get(r'https://epidemic-stats.com/coronavirus/{country}'
+                                                    .format(country=country))
+            if parsed_entry is not None and parsed_entry['data'] is pages[country] \
+                    and all([i in parsed_entry for i in data_types]):
+                return {i: parsed_entry[i] for i in data_types}
+            if parse_pool is not None:
+                try:
+                    return parse_pool.submit(_parse_country_page_v3, pages[country], data_types).result()
+                except BrokenProcessPool as e:
+                    self.print(f"Process pool broken in CovidParser.fetch_countries, parsing in-process ({repr(e)})")
+                    self.__discard_parse_pool_v3(parse_workers, parse_pool)
+            return _parse_country_page_v3(pages[country], data_types)
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as download_pool:
+            downloads = {country: download_pool.submit(__fetch_countries_download, country)
+                         for country in countries}
+            parses = {}
+            # Hand each page over to the parse pool as soon as it has been downloaded
+            for country in countries:
+                try:
+                    pages[country] = downloads[country].result()
+                except urllib.error.HTTPError:
+                    results[country] = 'Unrecognised location'
+                    continue
+                except (OSError, ValueError) as e:
+                    self.print(f"Failed to download {country} in CovidParser.fetch_countries ({repr(e)})")
+                    results[country] = 'Download failed'
+                    continue
+                parses[country] = download_pool.submit(__fetch_countries_parse, country)
+            for country in parses:
+                try:
+                    parsed[country] = parses[country].result()
+                except Exception as e:
+                    self.print(f"Failed to parse {country} in CovidParser.fetch_countries ({repr(e)})")
+                    results[country] = 'Unsupported page format'
+                    continue
+                results[country] = 'ok'
+
+        # The pages are already in the cache, so only the parsed data has to be loaded
+        for country in parsed:
+            url = r'https://epidemic-stats.com/coronavirus/{country}'.format(country=country)
+            self.parsed_cache_v3[url] = {'data': pages[country], **parsed[country]}
+        out_full['content'] = json.dumps({name: results[slugs[name]] for name in names})
+        return out_full
+
+    # Function to export every parsed series for the Australian locations to a snapshot file
+    # The file is written next to the destination and then moved into place, so readers never see a partial file
+    def export_snapshot(self, path: str, data_types: list = None) -> StandardReturnTypeV3:
+        if data_types is None:
+            data_types = SNAPSHOT_DATA_TYPES_V3
+        out_full = {
+            'status': 'ok',
+            'content': '',
+            'classified': 0
+        }
+        index = {'byteorder': sys.byteorder, 'series': {}}
+        columns = []
+        offset = 0
+        for location in self.__locations_v3:
+            for data_type in data_types:
+                # Only series of per day rows can be written, which leaves out vaccinations-percent and the like
+                if self.__series_table_v3(location, data_type) is None:
+                    continue
+                dates = []
+                values = array('q')
+                try:
+                    # The rows are oldest first, and the snapshot is newest first like CovidParser.new
+                    for day, value in reversed(list(self.__series_rows_v3(location, data_type))):
+                        dates.append(str(day).encode('utf-8'))
+                        try:
+                            values.append(int(value))
+                        except (TypeError, ValueError):
+                            values.append(SNAPSHOT_MISSING_V3)
+                except urllib.error.URLError as e:
+                    # Don't replace a good snapshot with one that is missing series
+                    self.print(f"Upstream unavailable in CovidParser.export_snapshot ({repr(e)})")
+                    out_full['status'] = 'error'
+                    out_full['content'] = 'Upstream unavailable'
+                    return out_full
+                except (KeyError, IndexError, TypeError, ValueError) as e:
+                    self.print(f"Skipping {location} {data_type} in CovidParser.export_snapshot ({repr(e)})")
+                    continue
+                date_width = max([len(i) for i in dates], default=0)
+                dates_blob = b''.join([i.ljust(date_width, b'\x00') for i in dates])
+                values_blob = values.tobytes()
+                entry = {'length': len(values), 'date_width': date_width}
+                # Keep every column 8 byte aligned so the integer columns can be cast without copying
+                entry['dates_offset'] = offset
+                offset = offset + len(dates_blob) + (-len(dates_blob) % 8)
+                entry['values_offset'] = offset
+                offset = offset + len(values_blob)
+                columns.append(dates_blob + b'\x00' * (-len(dates_blob) % 8))
+                columns.append(values_blob)
+                index['series'].setdefault(location, {})[data_type] = entry
+
+        header = json.dumps(index).encode('utf-8')
+        # Pad the header so the data region starts on an 8 byte boundary
+        header = header + b' ' * (-(len(SNAPSHOT_MAGIC_V3) + 4 + len(header)) % 8)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(SNAPSHOT_MAGIC_V3)
+                f.write(struct.pack('<I', len(header)))
+                f.write(header)
+                for column in columns:
+                    f.write(column)
+            os.replace(temp_path, path)
+        finally:
+            # Don't leave a partly written file behind if writing failed
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        out_full['content'] = path
+        return out_full
+
+    # Function to return a series as a TimeSeriesV3, filled straight from the decoded tables of its connector
+    # Anything which isn't a series of per day rows in a table goes through _new_v3, and is converted if it is a list
+    def __new_native_v3(self, location: str = 'aus', data_type: str = 'cases',
+                        date_range: DateRangeTypeV3 = None) -> StandardReturnTypeV3:
+        if date_range is None:
+            date_range = {'type': 'days', 'value': 2}
+        resolved = self.__resolve_location_v3(location)
+        if resolved is None or self.__series_table_v3(resolved, data_type) is None or \
+                date_range['type'] not in ('days', 'all'):
+            out = self._new_v3(location=location, data_type=data_type, date_range=date_range, include_date=True)
+            if out['status'] == 'ok':
+                content = json.loads(out['content'])
+                if isinstance(content, list):
+                    out['content'] = TimeSeriesV3.from_rows(content)
+            return out
+        series = TimeSeriesV3.from_pairs(self.__series_rows_v3(resolved, data_type))
+        if date_range['type'] == 'days':
+            series = series[max(len(series) - int(date_range['value']), 0):]
+        return {
+            'status': 'ok',
+            'content': series,
+            'classified': 0
+        }
+
+    # If native is True, then the content of a successful response is a TimeSeriesV3 object instead of JSON
+    # (except for data_types that aren't series, such as vaccinations-percent, and the all-states location)
+    # If deadline is set, then the call doesn't wait for upstream for longer than that many seconds
     def new(self, location: str = 'aus', data_type: str = 'cases',
-            date_range: DateRangeTypeV3 = None, include_date: bool = False) -> StandardReturnTypeV3:
-        return self._new_v3(location=location.lower(), data_type=data_type.lower(),
-                            date_range=date_range, include_date=include_date)
+            date_range: DateRangeTypeV3 = None, include_date: bool = False,
+            native: bool = False, deadline: float = None, as_of=None) -> StandardReturnTypeV3:
+        if as_of is not None:
+            return self._new_as_of_v3(location=location.lower(), data_type=data_type.lower(), date_range=date_range,
+                                      include_date=include_date, as_of=as_of)
+        if native is True:
+            return self.__run_query_v3(lambda: self.__new_native_v3(location=location.lower(),
+                                                                    data_type=data_type.lower(),
+                                                                    date_range=date_range), deadline)
+        return self.__run_query_v3(lambda: self._new_v3(location=location.lower(), data_type=data_type.lower(),
+                                                        date_range=date_range, include_date=include_date), deadline)
+
+    def new_matrix(self, data_type: str = 'cases', date_range: DateRangeTypeV3 = None,
+                   include_national: bool = False, deadline: float = None) -> StandardReturnTypeV3:
+        return self.__run_query_v3(lambda: self._new_matrix_v3(data_type=data_type.lower(), date_range=date_range,
+                                                               include_national=include_national), deadline)
 
     def total(self, location: str = 'aus', data_type: str = 'cases',
-              date_range: DateRangeTypeV3 = None) -> StandardReturnTypeV3:
-        return self._total_v3(location=location.lower(), data_type=data_type.lower(), date_range=date_range)
+              date_range: DateRangeTypeV3 = None, deadline: float = None) -> StandardReturnTypeV3:
+        return self.__run_query_v3(lambda: self._total_v3(location=location.lower(), data_type=data_type.lower(),
+                                                          date_range=date_range), deadline)
+
+    def rank(self, data_type: str = 'cases', metric: str = 'sum', window: int = 7, locations: list = None,
+             top: int = None, deadline: float = None) -> StandardReturnTypeV3:
+        return self.__run_query_v3(lambda: self._rank_v3(data_type=data_type.lower(), metric=metric.lower(),
+                                                         window=window, locations=locations, top=top), deadline)
+
+    # Dictionary of locations, their appropriate functions, and various other data
+    # This is shared by every CovidParser object, and is defined after the methods so that it can refer to them
+    __locations_v3 = {'aus': {'new_function': __get_aus_new_v3},
+                      'nsw': {
+                          # Function to call for per day new cases|deaths|recoveries
+                          'new_function': __get_state_new_v3,
+                          'new_cases_index': 1,  # Index required for part of __get_state_new_v3
+                          'new_deaths_index': 1,  # Index required for part of __get_state_new_v3
+                          'new_recoveries_index': 1,  # Index required for part of __get_state_new_v3
+                          'new_vaccinations_index': 1,  # Index required for part of __get_state_new_v3
+                          'vaccinations_percent_index': 0  # Index required for part of __get_state_new_v3
+                      },
+                      'vic': {'new_function': __get_state_new_v3,
+                              'new_cases_index': 2,
+                              'new_deaths_index': 2,
+                              'new_recoveries_index': 2,
+                              'new_vaccinations_index': 2,
+                              'vaccinations_percent_index': 1},
+                      'qld': {'new_function': __get_state_new_v3,
+                              'new_cases_index': 3,
+                              'new_deaths_index': 3,
+                              'new_recoveries_index': 3,
+                              'new_vaccinations_index': 3,
+                              'vaccinations_percent_index': 2},
+                      'sa': {'new_function': __get_state_new_v3,
+                             'new_cases_index': 4,
+                             'new_deaths_index': 4,
+                             'new_recoveries_index': 4,
+                             'new_vaccinations_index': 4,
+                             'vaccinations_percent_index': 3},
+                      'wa': {'new_function': __get_state_new_v3,
+                             'new_cases_index': 5,
+                             'new_deaths_index': 5,
+                             'new_recoveries_index': 5,
+                             'new_vaccinations_index': 5,
+                             'vaccinations_percent_index': 4},
+                      'tas': {'new_function': __get_state_new_v3,
+                              'new_cases_index': 6,
+                              'new_deaths_index': 6,
+                              'new_recoveries_index': 6,
+                              'new_vaccinations_index': 6,
+                              'vaccinations_percent_index': 5},
+                      'nt': {'new_function': __get_state_new_v3,
+                             'new_cases_index': 7,
+                             'new_deaths_index': 7,
+                             'new_recoveries_index': 7,
+                             'new_vaccinations_index': 7,
+                             'vaccinations_percent_index': 6},
+                      'act': {'new_function': __get_state_new_v3,
+                              'new_cases_index': 8,
+                              'new_deaths_index': 8,
+                              'new_recoveries_index': 8,
+                              'new_vaccinations_index': 8,
+                              'vaccinations_percent_index': 7}
+                      }
+
+    # Mapping of long/full location names to their corresponding names in __locations_v3
+    __locations_long_v3 = {'australia': 'aus',
+                           'new south wales': 'nsw',
+                           'victoria': 'vic',
+                           'queensland': 'qld',
+                           'south australia': 'sa',
+                           'western australia': 'wa',
+                           'tasmania': 'tas',
+                           'northern territory': 'nt',
+                           'australian capital territory': 'act',
+                           'america': 'usa'
+                           }
+
+
+# Compact series of per day values, oldest first
+# The day of each entry (as a date ordinal, or 0 if unknown) and its value are stored in two typed arrays,
+# and slicing returns a view onto the same arrays rather than a copy
+class TimeSeriesV3:
+    __slots__ = ('days', 'values', '_start', '_stop', '_json')
+
+    def __init__(self, days: array, values: array, start: int = 0, stop: int = None):
+        self.days = days
+        self.values = values
+        self._start = start
+        self._stop = len(values) if stop is None else stop
+        # Cache of the JSON output, keyed by include_date
+        self._json = {}
+        return
+
+    # Function to create a TimeSeriesV3 from the rows returned by CovidParser.new, which are newest first
+    # Each row is either a value, or a [date, value] list
+    @classmethod
+    def from_rows(cls, rows: list):
+        days = array('q')
+        values = array('q')
+        for row in reversed(rows):
+            if isinstance(row, list):
+                days.append(_date_to_ordinal_v3(str(row[0])) if len(row) > 0 else 0)
+                value = row[1] if len(row) > 1 else ''
+            else:
+                days.append(0)
+                value = row
+            try:
+                values.append(int(value))
+            except (TypeError, ValueError):
+                values.append(MISSING_VALUE_V3)
+        return cls(days, values)
+
+    # Function to create a TimeSeriesV3 from (date, value) pairs, oldest first, without holding them all in memory
+    @classmethod
+    def from_pairs(cls, pairs):
+        days = array('q')
+        values = array('q')
+        for day, value in pairs:
+            days.append(_date_to_ordinal_v3(str(day)))
+            try:
+                values.append(int(value))
+            except (TypeError, ValueError):
+                values.append(MISSING_VALUE_V3)
+        return cls(days, values)
+
+    def __len__(self):
+        return self._stop - self._start
+
+    # Returns a (date, value) tuple for an index, or a view for a slice
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError('TimeSeriesV3 slices must have a step of 1')
+            return TimeSeriesV3(self.days, self.values, self._start + start, self._start + max(start, stop))
+        if key < 0:
+            key = key + len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError('TimeSeriesV3 index out of range')
+        return self.__date(self.days[self._start + key]), self.__value(self.values[self._start + key])
+
+    def __iter__(self):
+        for i in range(self._start, self._stop):
+            yield self.__date(self.days[i]), self.__value(self.values[i])
+
+    def __repr__(self):
+        return f'<TimeSeriesV3 of {len(self)} entries>'
+
+    @staticmethod
+    def __date(day: int) -> str:
+        if day == 0:
+            return ''
+        return date.fromordinal(day).strftime(DATE_FORMATS_V3[0])
+
+    @staticmethod
+    def __value(value: int):
+        if value == MISSING_VALUE_V3:
+            return None
+        return value
+
+    def dates(self) -> list:
+        return [self.__date(self.days[i]) for i in range(self._start, self._stop)]
+
+    # Sum of the values, ignoring missing entries
+    def sum(self) -> int:
+        total = 0
+        for i in range(self._start, self._stop):
+            if self.values[i] != MISSING_VALUE_V3:
+                total = total + self.values[i]
+        return total
+
+    # Mean of the values, ignoring missing entries, or None if there aren't any values
+    def mean(self):
+        count = 0
+        for i in range(self._start, self._stop):
+            if self.values[i] != MISSING_VALUE_V3:
+                count = count + 1
+        if count == 0:
+            return None
+        return self.sum() / count
+
+    # Function to return a new series of the change from each entry to the next, which is one entry shorter
+    def diff(self):
+        days = array('q')
+        values = array('q')
+        for i in range(self._start + 1, self._stop):
+            days.append(self.days[i])
+            if self.values[i] == MISSING_VALUE_V3 or self.values[i - 1] == MISSING_VALUE_V3:
+                values.append(MISSING_VALUE_V3)
+            else:
+                values.append(self.values[i] - self.values[i - 1])
+        return TimeSeriesV3(days, values)
+
+    # Function to return the values (or [date, value] lists) as a list, oldest first, with None for missing entries
+    def to_list(self, include_date: bool = False) -> list:
+        if include_date is True:
+            return [[i[0], i[1]] for i in self]
+        return [self.__value(self.values[i]) for i in range(self._start, self._stop)]
+
+    # Function to return the output of to_list as JSON, which is only built the first time it is needed
+    def to_json(self, include_date: bool = False) -> str:
+        if include_date not in self._json:
+            self._json[include_date] = json.dumps(self.to_list(include_date=include_date))
+        return self._json[include_date]
+
+
+# Read only view of a snapshot file written by CovidParser.export_snapshot
+# The file is memory mapped, so any number of processes can share a single physical copy of it
+class CovidSnapshotV3:
+    def __init__(self, path: str):
+        self.path = path
+        self.__file = None
+        self.__map = None
+        self.__open()
+        return
+
+    # Function to map the file and load the index
+    # The new file is checked before the old one is closed, so a bad file leaves the current snapshot in use
+    def __open(self):
+        f = open(self.path, 'rb')
+        snapshot_map = None
+        try:
+            try:
+                snapshot_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError(f'Empty snapshot file {self.path}')
+            if snapshot_map[:len(SNAPSHOT_MAGIC_V3)] != SNAPSHOT_MAGIC_V3:
+                raise ValueError(f'Not a CovidParser snapshot file {self.path}')
+            header_start = len(SNAPSHOT_MAGIC_V3) + 4
+            header_length = struct.unpack('<I', snapshot_map[len(SNAPSHOT_MAGIC_V3):header_start])[0]
+            index = json.loads(snapshot_map[header_start:header_start + header_length])
+            if index['byteorder'] != sys.byteorder:
+                raise ValueError(f'Snapshot file {self.path} was written on a machine with a different byte order')
+            # Raises BufferError (and keeps the old snapshot) if values from series() haven't been released
+            self.close()
+        except BaseException:
+            if snapshot_map is not None:
+                snapshot_map.close()
+            f.close()
+            raise
+        self.__file = f
+        self.__map = snapshot_map
+        self.__inode = os.fstat(f.fileno()).st_ino
+        self.__data_start = header_start + header_length
+        self.__series = index['series']
+        return
+
+    # Function to switch to a newer snapshot if the file has been replaced since it was opened
+    # Returns True if a new snapshot was loaded
+    def refresh(self) -> bool:
+        try:
+            if os.stat(self.path).st_ino == self.__inode:
+                return False
+        except FileNotFoundError:
+            return False
+        self.__open()
+        return True
+
+    def close(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+    def locations(self) -> list:
+        return list(self.__series)
+
+    def data_types(self, location: str) -> list:
+        return list(self.__series.get(location, {}))
+
+    # Function to return the dates and values of a series, newest first (the same order as CovidParser.new)
+    # If length is set, then only that many of the newest rows are read
+    # The values are a memoryview straight onto the mapped file, and missing entries are SNAPSHOT_MISSING_V3
+    # Call .release() on the values before calling refresh() or close(), otherwise the file can't be unmapped
+    def series(self, location: str, data_type: str, length: int = None):
+        entry = self.__series[location][data_type]
+        length = entry['length'] if length is None else max(min(length, entry['length']), 0)
+        start = self.__data_start + entry['dates_offset']
+        width = entry['date_width']
+        dates = [self.__map[start + i * width:start + (i + 1) * width].rstrip(b'\x00').decode('utf-8')
+                 for i in range(0, length)]
+        start = self.__data_start + entry['values_offset']
+        values = memoryview(self.__map)[start:start + length * 8].cast('q')
+        return dates, values
+
+    # Function to answer the same queries as CovidParser.new for the Australian locations, using only the snapshot
+    def new(self, location: str = 'aus', data_type: str = 'cases', date_range: DateRangeTypeV3 = None,
+            include_date: bool = False) -> StandardReturnTypeV3:
+        if date_range is None:
+            date_range = {'type': 'days', 'value': 2}
+        out_full = {
+            'status': 'ok',
+            'content': '',
+            'classified': 0
+        }
+        location = location.lower()
+        data_type = data_type.lower()
+        if data_type not in self.__series.get(location, {}):
+            out_full['status'] = 'error'
+            out_full['content'] = 'Not in snapshot'
+            return out_full
+        if date_range['type'] == 'days':
+            length = int(date_range['value'])
+        elif date_range['type'] == 'all':
+            length = None
+        else:
+            out_full['status'] = 'error'
+            out_full['content'] = 'Unsupported date_range'
+            return out_full
+        dates, values = self.series(location, data_type, length)
+        length = len(dates)
+        out = []
+        for i in range(0, length):
+            value = '' if values[i] == SNAPSHOT_MISSING_V3 else str(values[i])
+            if include_date is True:
+                out.append([dates[i], value])
+            else:
+                out.append(value)
+        values.release()
+        out_full['content'] = json.dumps(out)
+        return out_full
+
+
+def load_snapshot(path: str) -> CovidSnapshotV3:
+    return CovidSnapshotV3(path)
+
+
+# Append-only SQLite archive of the rows of every series, recording only the rows which changed in each refresh
+# Each refresh of a source which changes anything gets a new version, so a series can be rebuilt as it was at any time
+class HistoryArchiveV3:
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        # Latest archived value of each date, for each (source, location, data_type), loaded when first needed
+        self.latest = {}
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS rows (source TEXT, location TEXT, data_type TEXT, '
+                                    'date TEXT, version INTEGER, value TEXT, recorded_at REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS rows_series ON rows '
+                                    '(source, location, data_type, date, version)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS versions (source TEXT, version INTEGER, '
+                                    'recorded_at REAL, PRIMARY KEY (source, version))')
+        return
+
+    # Function to record one refresh of a source, given the rows of each of its series as {(location, data_type):
+    # {date: value}}, storing only the dates whose value has changed under a new version of the source
+    # Returns the number of rows stored
+    def record(self, source: str, series: dict, recorded_at: float = None) -> int:
+        if recorded_at is None:
+            recorded_at = time()
+        with self.lock:
+            changed = []
+            for location, data_type in series:
+                key = (source, location, data_type)
+                if key not in self.latest:
+                    self.latest[key] = dict(self.__rows_v3(source, location, data_type, None))
+                latest = self.latest[key]
+                changed.extend([(location, data_type, str(day), value)
+                                for day, value in series[(location, data_type)].items()
+                                if latest.get(str(day)) != value])
+            if len(changed) == 0:
+                return 0
+            with self.connection:
+                version = self.connection.execute(
+                    'SELECT COALESCE(MAX(version), 0) + 1 FROM versions WHERE source = ?', (source,)).fetchone()[0]
+                self.connection.execute('INSERT INTO versions VALUES (?, ?, ?)', (source, version, recorded_at))
+                self.connection.executemany('INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                            [(source, location, data_type, day, version, value, recorded_at)
+                                             for location, data_type, day, value in changed])
+            for location, data_type, day, value in changed:
+                self.latest[(source, location, data_type)][day] = value
+        return len(changed)
+
+    # Function to return the rows [(date, value), ...] of a series (oldest first) as they were at the as_of timestamp
+    def series(self, source: str, location: str, data_type: str, as_of: float = None) -> list:
+        with self.lock:
+            rows = self.__rows_v3(source, location, data_type, as_of)
+        # Dates are sorted as dates, and the day numbers of epidemic-stats locations as numbers
+        rows.sort(key=lambda i: int(i[0]) if i[0].isdigit() else _date_to_ordinal_v3(i[0]))
+        return rows
+
+    def __rows_v3(self, source, location, data_type, as_of):
+        if as_of is None:
+            as_of = float('inf')
+        # The latest version of each date which was recorded by as_of
+        return self.connection.execute(
+            'SELECT date, value FROM rows AS r WHERE source = ? AND location = ? AND data_type = ? '
+            'AND recorded_at <= ? AND version = (SELECT MAX(version) FROM rows WHERE source = r.source '
+            'AND location = r.location '
+            'AND data_type = r.data_type AND date = r.date AND recorded_at <= ?)',
+            (source, location, data_type, as_of, as_of)).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+        return
@@ -0,0 +1,114 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/). All Rights Reserved.
+# Command line entry point, run with: python -m CovidParser <command>
+
+import argparse  # Used for parsing command line arguments
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m CovidParser')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cache_daemon_parser = commands.add_parser('cache-daemon', help='Run a local cache daemon on a Unix socket')
+    cache_daemon_parser.add_argument('--socket', required=True, help='Path of the Unix socket to listen on')
+    cache_daemon_parser.add_argument('--cache-type', type=int, default=2, help='See CovidParser cache_type')
+    cache_daemon_parser.add_argument('--cache-update-interval', type=int, default=300,
+                                     help='See CovidParser cache_update_interval')
+    cache_daemon_parser.add_argument('--log-file', default=None, help='File to log to')
+    cache_daemon_parser.add_argument('--rate-limit', type=float, default=None,
+                                     help='Maximum upstream requests per second, see CovidParser.FetchSchedulerV3')
+    cache_daemon_parser.add_argument('--host-limit', type=int, default=None,
+                                     help='Maximum upstream requests to each host at once')
+
+    serve_parser = commands.add_parser('serve', help='Run an HTTP service with JSON endpoints for the query API')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    serve_parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    serve_parser.add_argument('--cache-type', type=int, default=2, help='See CovidParser cache_type')
+    serve_parser.add_argument('--cache-update-interval', type=int, default=300,
+                              help='See CovidParser cache_update_interval')
+    serve_parser.add_argument('--cache-socket', default=None, help='See CovidParser cache_socket')
+    serve_parser.add_argument('--response-ttl', type=int, default=5,
+                              help='Seconds to reuse a serialized response for')
+    serve_parser.add_argument('--max-responses', type=int, default=1024,
+                              help='Maximum number of serialized responses to keep')
+    serve_parser.add_argument('--workers', type=int, default=8, help='Number of threads to run queries in')
+    serve_parser.add_argument('--log-file', default=None, help='File to log to')
+    serve_parser.add_argument('--rate-limit', type=float, default=None,
+                              help='Maximum upstream requests per second, see CovidParser.FetchSchedulerV3')
+    serve_parser.add_argument('--host-limit', type=int, default=None,
+                              help='Maximum upstream requests to each host at once')
+
+    loadtest_parser = commands.add_parser('loadtest', help='Run a load test against a simulated upstream')
+    loadtest_parser.add_argument('--threads', type=int, default=8, help='Number of threads making queries')
+    loadtest_parser.add_argument('--duration', type=float, default=10, help='Seconds to run for')
+    loadtest_parser.add_argument('--cache-type', type=int, default=2, help='See CovidParser cache_type')
+    loadtest_parser.add_argument('--cache-update-interval', type=int, default=5,
+                                 help='See CovidParser cache_update_interval')
+    loadtest_parser.add_argument('--latency', type=float, default=0.05, help='Seconds of simulated upstream latency')
+    loadtest_parser.add_argument('--jitter', type=float, default=0.0, help='Extra random seconds of latency, up to')
+    loadtest_parser.add_argument('--failure-rate', type=float, default=0.0,
+                                 help='Fraction of upstream requests to fail with a 503')
+    loadtest_parser.add_argument('--days', type=int, default=600, help='Number of days of simulated data')
+    loadtest_parser.add_argument('--object-per-thread', action='store_true',
+                                 help='Give each thread its own CovidParser object instead of sharing one')
+    loadtest_parser.add_argument('--seed', type=int, default=None, help='Random seed for the query mix')
+
+    commands.add_parser('memcheck', help='Check the peak memory of representative calls against their budgets')
+
+    export_parser = commands.add_parser('export', help='Write every row of every series to a CSV or NDJSON file')
+    export_parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv', help='Format to write')
+    export_parser.add_argument('--output', default='-', help='File to write to, or - for the standard output')
+    export_parser.add_argument('--since', default=None, help='Only write rows for dates after this one')
+    export_parser.add_argument('--locations', default=None,
+                               help='Comma separated locations to export, defaults to the Australian locations')
+    export_parser.add_argument('--data-types', default=None,
+                               help='Comma separated data_types to export, defaults to every series data_type')
+    export_parser.add_argument('--cache-socket', default=None, help='See CovidParser cache_socket')
+    export_parser.add_argument('--log-file', default=None, help='File to log to')
+
+    args = parser.parse_args(argv)
+    scheduler = None
+    if getattr(args, 'rate_limit', None) is not None or getattr(args, 'host_limit', None) is not None:
+        from . import FetchSchedulerV3
+        scheduler = FetchSchedulerV3(rate=args.rate_limit, default_host_limit=args.host_limit)
+    if args.command == 'cache-daemon':
+        from .cache_daemon import serve_cache_daemon
+        serve_cache_daemon(args.socket, cache_type=args.cache_type,
+                           cache_update_interval=args.cache_update_interval, log_file=args.log_file,
+                           scheduler=scheduler)
+    elif args.command == 'serve':
+        from .server import serve
+        serve(host=args.host, port=args.port, cache_type=args.cache_type,
+              cache_update_interval=args.cache_update_interval, log_file=args.log_file,
+              cache_socket=args.cache_socket, response_ttl=args.response_ttl, workers=args.workers,
+              scheduler=scheduler, max_responses=args.max_responses)
+    elif args.command == 'loadtest':
+        from .loadtest import run_load_test, format_report
+        print(format_report(run_load_test(
+            threads=args.threads, duration=args.duration, cache_type=args.cache_type,
+            cache_update_interval=args.cache_update_interval, latency=args.latency, jitter=args.jitter,
+            failure_rate=args.failure_rate, days=args.days, shared_object=not args.object_per_thread,
+            seed=args.seed)))
+    elif args.command == 'memcheck':
+        from .memcheck import run_memcheck, format_memcheck
+        results = run_memcheck()
+        print(format_memcheck(results))
+        # Fail if any of the calls went over their budget
+        if any([peak > budget for name, peak, budget in results]):
+            return 1
+    elif args.command == 'export':
+        from . import CovidParser
+        from .exporter import run_export
+        covid = CovidParser(cache_socket=args.cache_socket, log_file=args.log_file)
+        try:
+            count = run_export(covid, output=args.output, export_format=args.format, since=args.since,
+                               locations=None if args.locations is None else args.locations.split(','),
+                               data_types=None if args.data_types is None else args.data_types.split(','))
+        except ValueError as e:
+            parser.error(str(e))
+        if args.output != '-':
+            print(f'Wrote {count} rows to {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,82 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/). All Rights Reserved.
+# Local cache daemon, so that any number of processes share one cache and each URL is only fetched once
+# Start it with: python -m CovidParser cache-daemon --socket /run/CovidParser.sock
+# Then create each CovidParser object with CovidParser.CovidParser(cache_socket='/run/CovidParser.sock')
+
+import os  # Used for removing stale socket files
+import socketserver  # Used for serving the Unix socket
+import threading  # Used for making sure each URL is only fetched by one connection at a time
+import urllib.error  # Used for passing HTTP errors on to clients
+from hashlib import sha1  # Used for building versions of the data
+
+from . import CovidParser
+
+
+class CacheDaemonV3(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, cache_type=2, cache_update_interval=300, log_file=None, scheduler=None):
+        # The CovidParser object which owns the shared cache
+        self.covid = CovidParser(cache_type=cache_type, cache_update_interval=cache_update_interval,
+                                 log_file=log_file, scheduler=scheduler)
+        # One lock per URL, so that concurrent requests for a URL wait for one fetch instead of all fetching it
+        self.url_locks = {}
+        self.url_locks_lock = threading.Lock()
+        # Dictionary of {url: (data, version)} for the last data sent for each URL
+        self.versions = {}
+        # Remove the socket file left behind by a previous daemon
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, CacheDaemonHandlerV3)
+        return
+
+    # Function to fetch a URL through the shared cache, making sure only one connection fetches it at a time
+    def fetch(self, url):
+        with self.url_locks_lock:
+            url_lock = self.url_locks.setdefault(url, threading.Lock())
+        with url_lock:
+            return self.covid._fetch_data_v3(url)
+
+    # Function to return the version of the data for a URL, which only changes when the data does
+    def version(self, url, data: str) -> str:
+        cached = self.versions.get(url)
+        if cached is not None and cached[0] is data:
+            return cached[1]
+        version = sha1(data.encode('utf-8')).hexdigest()[:20]
+        self.versions[url] = (data, version)
+        return version
+
+
+# Each request is a "<url> [<version of the client's copy>]" line. The reply is "ok <length> <version>" followed by
+# the data, "notmodified <version>" if the client's copy is current, "httperror <code>", or "error <length>"
+# followed by the error if the URL couldn't be fetched
+class CacheDaemonHandlerV3(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = self.rfile.readline().decode('utf-8').split()
+        url = request[0]
+        try:
+            data = self.server.fetch(url)
+        except urllib.error.HTTPError as e:
+            self.wfile.write(f'httperror {e.code}\n'.encode('utf-8'))
+            return
+        except Exception as e:
+            data = repr(e).encode('utf-8')
+            self.wfile.write(f'error {len(data)}\n'.encode('utf-8') + data)
+            return
+        version = self.server.version(url, data)
+        if len(request) > 1 and request[1] == version:
+            self.wfile.write(f'notmodified {version}\n'.encode('utf-8'))
+            return
+        data = data.encode('utf-8')
+        self.wfile.write(f'ok {len(data)} {version}\n'.encode('utf-8') + data)
+        return
+
+
+def serve_cache_daemon(socket_path, cache_type=2, cache_update_interval=300, log_file=None, scheduler=None):
+    with CacheDaemonV3(socket_path, cache_type=cache_type, cache_update_interval=cache_update_interval,
+                       log_file=log_file, scheduler=scheduler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+    return
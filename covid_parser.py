@@ -4,6 +4,15 @@
 import urllib.request
 import json
 
+try:
+    from . import CovidParser, _parse_country_page_v3, COUNTRY_MARKERS_V3
+except ImportError:
+    from __init__ import CovidParser, _parse_country_page_v3, COUNTRY_MARKERS_V3
+
+
+# Shared CovidParser object which does all of the downloading and caching for this module
+# Replace it to change the caching, e.g. covid_parser.engine = CovidParser(cache_type=1, cache_update_interval=3)
+engine = CovidParser(cache_type=2, cache_update_interval=300, shared_cache=True)
 
 aus_locations = {'aus': 1, 'nsw': 1, 'vic': 2, 'qld': 3, 'sa': 4, 'wa': 5, 'tas': 6, 'nt': 7, 'act': 8}
 aus_states = {'nsw': 1, 'vic': 2, 'qld': 3, 'sa': 4, 'wa': 5, 'tas': 6, 'nt': 7, 'act': 8}
@@ -16,27 +25,50 @@ def rreplace(s, old, _new, occurrence):
     return _new.join(li)
 
 
+# Function to copy the rows of parsed data, so that callers can change them without changing the cached data
+def copy_rows(rows):
+    return [list(i) if isinstance(i, list) else i for i in rows]
+
+
 def download_data(url):
-    with urllib.request.urlopen(url) as response:
-        data = response.read().decode('utf-8')
-    return data
+    return engine._fetch_data_v3(url)
+
+
+# Function to download a URL and parse it with parse(data), only parsing it again once the cached data changes
+# The parsed data is stored in the engine's parsed cache under key, along with the data it was parsed from
+# If markers is set, then the page is streamed and only the arrays following the markers are kept
+def download_parsed(url, key, parse, markers=None):
+    if markers is None:
+        data = download_data(url)
+    else:
+        data = engine._fetch_section_v3(url, markers)
+    parsed = engine.parsed_cache_v3.get(url)
+    if parsed is None or parsed['data'] is not data:
+        parsed = {'data': data}
+        engine.parsed_cache_v3[url] = parsed
+    if key not in parsed:
+        parsed[key] = parse(data)
+    return parsed[key]
+
+
+# Function to parse the data array following marker out of a streamed infogram page
+def parse_infogram(data, marker, slash):
+    junk, data = data.split(marker)
+    data = data.replace(slash, '/')
+    return json.loads(data)[0]
 
 
 def get_state_new(data_type='cases'):
     if data_type == 'cases':
-        data = download_data(r'https://infogram.com/1p0lp9vmnqd3n9te63x3q090ketnx57evn5?live')
-        junk, data = data.split('dbf","chart_type_nr":10,"data":[')
-        data, junk = data.split('],"custom":{"showPoints":true')
-        data = data.replace(r'\u002F', '/')
-        statedata = json.loads(data)
-        return statedata
+        statedata = download_parsed(r'https://infogram.com/1p0lp9vmnqd3n9te63x3q090ketnx57evn5?live', 'legacy',
+                                    lambda data: parse_infogram(data, 'dbf","chart_type_nr":10,"data":', r'\u002F'),
+                                    markers=['dbf","chart_type_nr":10,"data":'])
+        return copy_rows(statedata)
     elif data_type == 'deaths':
-        data = download_data(r'https://e.infogram.com/90ab7c54-efe3-4d76-a3f6-19c8544249e4?live')
-        junk, data = data.split('a3b","chart_type_nr":10,"data":[')
-        data, junk = data.split('],"custom":{"showPoints":false')
-        data = data.replace(r'\u002f', '/')
-        statedata = json.loads(data)
-        return statedata
+        statedata = download_parsed(r'https://e.infogram.com/90ab7c54-efe3-4d76-a3f6-19c8544249e4?live', 'legacy',
+                                    lambda data: parse_infogram(data, 'a3b","chart_type_nr":10,"data":', r'\u002f'),
+                                    markers=['a3b","chart_type_nr":10,"data":'])
+        return copy_rows(statedata)
     # elif data_type == 'recoveries':
         # data = download_data(r'https://e.infogram.com/_/1x9ogDI1RFHnyzW4sfFx')
         # junk, data = data.split(r'c19","chart_type_nr":1,"data":', 1)
@@ -101,18 +133,18 @@ def get_state_new(data_type='cases'):
 
 
 def get_state_new_v2(data_type='cases', location='vic'):
-    data = download_data(r"https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20")
-    data = json.loads(data)
+    data = download_parsed(r"https://atlas.jifo.co/api/connectors/0b334273-5661-4837-a639-e3a384d81d20", 'legacy',
+                           json.loads)
     data = data["data"]
     if data_type == 'cases':
-        data = data[8]
+        data = copy_rows(data[8])
         return data
     if data_type == 'deaths':
-        data = data[15]
+        data = copy_rows(data[15])
         return data
     if data_type == 'recoveries':
-        data1 = download_data(r'https://atlas.jifo.co/api/connectors/f3401355-a94b-4360-a1f8-1f23478840ad')
-        data1 = json.loads(data1)
+        data1 = download_parsed(r'https://atlas.jifo.co/api/connectors/f3401355-a94b-4360-a1f8-1f23478840ad',
+                                'legacy', json.loads)
         statedata = list()
         for i in range(1, len(data1["data"][0])):
             tmp1 = list()
@@ -126,19 +158,15 @@ def get_state_new_v2(data_type='cases', location='vic'):
 
 def get_aus_new(data_type='cases'):
     if data_type == 'cases':
-        data = download_data(r'https://infogram.com/1p7ve7kjeld1pebz2nm0vpqv7nsnp92jn2x?live')
-        junk, data = data.split('a7e","chart_type_nr":1,"data":[')
-        data, junk = data.split('],"custom":{"showPoints":true')
-        data = data.replace(r'\u002F', '/')
-        ausdata = json.loads(data)
-        return ausdata
+        ausdata = download_parsed(r'https://infogram.com/1p7ve7kjeld1pebz2nm0vpqv7nsnp92jn2x?live', 'legacy',
+                                  lambda data: parse_infogram(data, 'a7e","chart_type_nr":1,"data":', r'\u002F'),
+                                  markers=['a7e","chart_type_nr":1,"data":'])
+        return copy_rows(ausdata)
     elif data_type == 'deaths':
-        data = download_data(r'https://e.infogram.com/154e01ec-a6e7-45da-8fcf-d6c9a6669ba8?live')
-        junk, data = data.split('aae","chart_type_nr":1,"data":[')
-        data, junk = data.split('],"custom":{"showPoints":false')
-        data = data.replace(r'\u002F', '/')
-        ausdata = json.loads(data)
-        return ausdata
+        ausdata = download_parsed(r'https://e.infogram.com/154e01ec-a6e7-45da-8fcf-d6c9a6669ba8?live', 'legacy',
+                                  lambda data: parse_infogram(data, 'aae","chart_type_nr":1,"data":', r'\u002F'),
+                                  markers=['aae","chart_type_nr":1,"data":'])
+        return copy_rows(ausdata)
     elif data_type == 'recoveries':
         ausdata = get_country_new('australia', data_type='recoveries')
         # print(ausdata)
@@ -146,28 +174,13 @@ def get_aus_new(data_type='cases'):
 
 
 def get_country_new(country='australia', data_type='cases'):
-    data = download_data(r'https://epidemic-stats.com/coronavirus/%s' % country)
-    if data_type == 'cases':
-        junk, data = data.split('infected_new = ')
-        data, junk = data.split('const recovered_new = ')
-        data = data.replace("'", '"')
-        data = rreplace(data, ',', '', 1)
-        countrydata = json.loads(data)
-        return countrydata
-    elif data_type == 'deaths':
-        junk, data = data.split('deaths_new = ')
-        data, junk = data.split('const infected_new = ')
-        data = data.replace("'", '"')
-        data = rreplace(data, ',', '', 1)
-        countrydata = json.loads(data)
-        return countrydata
-    elif data_type == 'recoveries':
-        junk, data = data.split('const recovered_new = ')
-        data, junk = data.split('const current_infected = ')
-        data = data.replace("'", '"')
-        data = rreplace(data, ',', '', 1)
-        countrydata = json.loads(data)
-        return countrydata
+    if data_type not in ('cases', 'deaths', 'recoveries'):
+        return None
+    # The parsed data is shared with the engine, so CovidParser.new() and this function only parse each page once
+    countrydata = download_parsed(r'https://epidemic-stats.com/coronavirus/%s' % country, data_type,
+                                  lambda data: _parse_country_page_v3(data, [data_type])[data_type],
+                                  markers=COUNTRY_MARKERS_V3)
+    return copy_rows(countrydata)
 
 
 def new_cases(location='aus'):  # Depreciated, use new(location=location, data_type='cases')
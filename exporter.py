@@ -0,0 +1,61 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/). All Rights Reserved.
+# Bulk exporter, which writes every row of every series to a CSV or NDJSON file as it is generated
+# Run it with: python -m CovidParser export --format csv --since 2021-07-01 --output covid.csv
+
+import csv  # Used for writing CSV output
+import json  # Used for writing NDJSON output
+import os  # Used for atomically replacing the output file
+import sys  # Used for writing to the standard output
+
+from . import CovidParser, DATE_FORMATS_V3, _date_to_ordinal_v3
+
+# Formats which can be exported, and the columns of each row
+EXPORT_FORMATS_V3 = ('csv', 'ndjson')
+EXPORT_COLUMNS_V3 = ['location', 'data_type', 'date', 'value']
+
+
+# Function to write the rows of a CovidParser object to output (a path, or '-' for the standard output)
+# A file is written next to the destination and then moved into place, so readers never see a partial export
+# Returns the number of rows written
+def run_export(covid: CovidParser, output: str = '-', export_format: str = 'csv', since: str = None,
+               locations: list = None, data_types: list = None) -> int:
+    if export_format not in EXPORT_FORMATS_V3:
+        raise ValueError(f"Unsupported export format {export_format}, expected one of {EXPORT_FORMATS_V3}")
+    if since is not None and _date_to_ordinal_v3(since) == 0:
+        raise ValueError(f"Unsupported date {since}, expected one of the formats {DATE_FORMATS_V3}")
+    if output == '-':
+        return _write_rows_v3(covid._export_rows_v3(locations, data_types, since), sys.stdout, export_format)
+    temporary = f'{output}.{os.getpid()}.tmp'
+    try:
+        with open(temporary, 'w', newline='') as f:
+            count = _write_rows_v3(covid._export_rows_v3(locations, data_types, since), f, export_format)
+        os.replace(temporary, output)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return count
+
+
+# Function to write each row to f as it is generated, returning the number of rows written
+# Values are written as integers where possible, and as empty values (or null) otherwise
+def _write_rows_v3(rows, f, export_format: str) -> int:
+    count = 0
+    if export_format == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_COLUMNS_V3)
+        for location, data_type, day, value in rows:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                value = ''
+            writer.writerow([location, data_type, day, value])
+            count = count + 1
+    else:
+        for location, data_type, day, value in rows:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                value = None
+            f.write(json.dumps({'location': location, 'data_type': data_type, 'date': day, 'value': value}) + '\n')
+            count = count + 1
+    return count
@@ -0,0 +1,218 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/). All Rights Reserved.
+# Load testing tool, which runs CovidParser against a simulated upstream from many threads at once
+# Run it with: python -m CovidParser loadtest --threads 16 --duration 10 --latency 0.05
+
+import json  # Used for building the simulated data
+import random  # Used for choosing queries, and for injecting latency and failures
+import threading  # Used for running the simulated upstream and the load threads
+from time import time, sleep  # Used for timing requests
+from datetime import date, timedelta  # Used for building the simulated dates
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler  # Used for serving the simulated upstream
+
+from . import CovidParser, DATE_FORMATS_V3
+
+# Countries served by the simulated epidemic-stats
+SIMULATED_COUNTRIES_V3 = ['usa', 'germany', 'france', 'italy', 'spain', 'india', 'brazil', 'japan', 'canada', 'mexico']
+# Mix of queries to run, as (weight, method, arguments)
+# A location of None means a random state, and 'country' means a random simulated country
+QUERY_MIX_V3 = [
+    (30, 'new', {'location': None, 'data_type': 'cases', 'date_range': {'type': 'days', 'value': 2}}),
+    (10, 'new', {'location': None, 'data_type': 'deaths', 'date_range': {'type': 'days', 'value': 14},
+                 'include_date': True}),
+    (10, 'new', {'location': 'aus', 'data_type': 'cases', 'date_range': {'type': 'all'}}),
+    (5, 'new', {'location': None, 'data_type': 'vaccinations', 'date_range': {'type': 'days', 'value': 7}}),
+    (5, 'new', {'location': None, 'data_type': 'vaccinations-percent'}),
+    (15, 'total', {'location': None, 'data_type': 'cases', 'date_range': {'type': 'all'}}),
+    (15, 'new', {'location': 'country', 'data_type': 'cases', 'date_range': {'type': 'days', 'value': 2}}),
+    (5, 'new_matrix', {'data_type': 'cases', 'date_range': {'type': 'days', 'value': 7}}),
+    (5, 'total', {'location': 'country', 'data_type': 'deaths', 'date_range': {'type': 'all'}}),
+]
+STATES_V3 = ['nsw', 'vic', 'qld', 'sa', 'wa', 'tas', 'nt', 'act']
+
+
+# Function to build the body of each simulated connector, with days worth of rows
+def _simulated_connectors_v3(days: int) -> dict:
+    first_day = date(2020, 3, 1)
+    dates = [(first_day + timedelta(days=i)).strftime(DATE_FORMATS_V3[0]) for i in range(0, days)]
+    main = [[['Date', 'Value']] for _ in range(0, 44)]
+    main[3] = [['Date', 'Cases']] + [[d, str(i % 50)] for i, d in enumerate(dates)]
+    main[11] = [['Date', 'Deaths']] + [[d, str(i % 3)] for i, d in enumerate(dates)]
+    main[7] = [['Date'] + STATES_V3] + [[d] + [str((i * s) % 40) for s in range(1, 9)] for i, d in enumerate(dates)]
+    main[16] = [['Date'] + STATES_V3] + [[d] + [str((i + s) % 2) for s in range(1, 9)] for i, d in enumerate(dates)]
+    main[43] = [['Date', '', '', '', '', 'Recoveries']] + [[d, '', '', '', '', str(i % 30)] for i, d in enumerate(dates)]
+    recoveries = [[]] + [[['Date', '', '', 'Total']] + [[d, '', '', str(i * s)] for i, d in enumerate(dates)]
+                         for s in range(1, 9)]
+    state_vaccinations = [['Date'] + STATES_V3] + [[d] + [str(i * 100 * s) for s in range(1, 9)]
+                                                   for i, d in enumerate(dates)]
+    return {
+        '0b334273-5661-4837-a639-e3a384d81d20': json.dumps({'data': main}),
+        '1806e38a-75e1-44b3-a9ed-fb384165cabf': json.dumps({'data': recoveries}),
+        '728c45eb-6045-4aa2-9bcc-9d2597424858': json.dumps(
+            {'data': [[['', str(50 + t + s)] for s in range(0, 8)] for t in range(0, 6)]}),
+        'ba5a3a2a-82ef-4225-b054-27227066c0c0': json.dumps({'data': [state_vaccinations, [], state_vaccinations]}),
+        '08ca8032-69d9-40c1-9bfe-b5610e768295': json.dumps({'data': [[[''], ['', '70', '60']] for _ in range(0, 3)]}),
+        '075c0786-674c-482b-91da-06fde61d025c': json.dumps(
+            {'data': [[['Date', 'First', 'Second']] + [[d, str(i * 10), str(i * 5)] for i, d in enumerate(dates)]]}),
+    }
+
+
+# Function to build a simulated epidemic-stats page, with padding either side of the data like the real pages
+def _simulated_country_page_v3(days: int) -> str:
+    def __array(multiplier):
+        return '[' + ''.join([f"'{(i * multiplier) % 1000}'," for i in range(0, days)]) + ']\n'
+    return ('<html><head>' + ' ' * 20000 + '</head><body><script>\n'
+            f'const deaths_new = {__array(1)}const infected_new = {__array(7)}'
+            f'const recovered_new = {__array(3)}const current_infected = [];\n</script>' + ' ' * 50000 + '</body></html>')
+
+
+# Local stand-in for atlas.jifo.co and epidemic-stats.com, with configurable latency and failure injection
+class SimulatedUpstreamV3(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, failure_rate=0.0, days=600):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.connectors = {k: v.encode('utf-8') for k, v in _simulated_connectors_v3(days).items()}
+        self.country_page = _simulated_country_page_v3(days).encode('utf-8')
+        # Number of requests received, and how many of them were failed on purpose
+        self.requests = 0
+        self.failures = 0
+        self.counter_lock = threading.Lock()
+        ThreadingHTTPServer.__init__(self, (host, port), SimulatedUpstreamHandlerV3)
+        return
+
+    def base_url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    # Dictionary to pass to CovidParser(upstream_overrides=...) to fetch from this server
+    def overrides(self) -> dict:
+        return {'https://atlas.jifo.co': self.base_url(), 'https://epidemic-stats.com': self.base_url()}
+
+
+class SimulatedUpstreamHandlerV3(BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.counter_lock:
+            self.server.requests = self.server.requests + 1
+        delay = self.server.latency + random.uniform(0, self.server.jitter)
+        if delay > 0:
+            sleep(delay)
+        if random.random() < self.server.failure_rate:
+            with self.server.counter_lock:
+                self.server.failures = self.server.failures + 1
+            self.send_error(503)
+            return
+        if self.path.startswith('/api/connectors/') and self.path[len('/api/connectors/'):] in self.server.connectors:
+            body = self.server.connectors[self.path[len('/api/connectors/'):]]
+        elif self.path.startswith('/coronavirus/') and self.path[len('/coronavirus/'):] in SIMULATED_COUNTRIES_V3:
+            body = self.server.country_page
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def log_message(self, format, *args):
+        return
+
+
+# Function to work out a percentile of a sorted list
+def _percentile_v3(values: list, percent: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+# Function to run the load test, returning a report dictionary
+# If shared_object is True, then every thread uses one CovidParser object, otherwise each thread has its own
+def run_load_test(threads=8, duration=10.0, cache_type=2, cache_update_interval=5, latency=0.05, jitter=0.0,
+                  failure_rate=0.0, days=600, shared_object=True, timeout=10, seed=None):
+    rng = random.Random(seed)
+    upstream = SimulatedUpstreamV3(latency=latency, jitter=jitter, failure_rate=failure_rate, days=days)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+
+    def __new_object():
+        # Errors are expected when failures are injected, so don't log them
+        covid = CovidParser(cache_type=cache_type, cache_update_interval=cache_update_interval, timeout=timeout,
+                            upstream_overrides=upstream.overrides())
+        covid.print = lambda data: None
+        return covid
+
+    shared = __new_object() if shared_object is True else None
+    weights = [i[0] for i in QUERY_MIX_V3]
+    latencies = []
+    errors = [0]
+    stats = []
+    results_lock = threading.Lock()
+    stop_at = time() + duration
+
+    def __load_thread(thread_seed):
+        thread_rng = random.Random(thread_seed)
+        covid = shared if shared is not None else __new_object()
+        thread_latencies = []
+        thread_errors = 0
+        while time() < stop_at:
+            weight, method, arguments = thread_rng.choices(QUERY_MIX_V3, weights=weights)[0]
+            arguments = dict(arguments)
+            if 'location' in arguments and arguments['location'] is None:
+                arguments['location'] = thread_rng.choice(STATES_V3)
+            elif arguments.get('location') == 'country':
+                arguments['location'] = thread_rng.choice(SIMULATED_COUNTRIES_V3)
+            if 'date_range' in arguments:
+                arguments['date_range'] = dict(arguments['date_range'])
+            start = time()
+            try:
+                out = getattr(covid, method)(**arguments)
+                if out['status'] != 'ok':
+                    thread_errors = thread_errors + 1
+            except Exception:
+                thread_errors = thread_errors + 1
+            thread_latencies.append(time() - start)
+        with results_lock:
+            latencies.extend(thread_latencies)
+            errors[0] = errors[0] + thread_errors
+            if shared is None:
+                stats.append(covid.cache_stats_v3)
+        return
+
+    started = time()
+    workers = [threading.Thread(target=__load_thread, args=(rng.random(),)) for _ in range(0, threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time() - started
+    upstream.shutdown()
+    upstream.server_close()
+
+    if shared is not None:
+        stats.append(shared.cache_stats_v3)
+    hits = sum([i['hits'] for i in stats])
+    misses = sum([i['misses'] for i in stats])
+    latencies.sort()
+    return {
+        'threads': threads,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': _percentile_v3(latencies, 50) * 1000,
+        'p99_ms': _percentile_v3(latencies, 99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+        'upstream_requests': upstream.requests,
+        'upstream_failures': upstream.failures,
+        'cache_hit_ratio': hits / (hits + misses) if hits + misses > 0 else 0.0,
+    }
+
+
+def format_report(report: dict) -> str:
+    return (f"threads:            {report['threads']}\n"
+            f"requests:           {report['requests']} ({report['errors']} errors)\n"
+            f"throughput:         {report['throughput']:.1f} requests/second\n"
+            f"latency:            p50 {report['p50_ms']:.2f}ms, p99 {report['p99_ms']:.2f}ms, "
+            f"max {report['max_ms']:.2f}ms\n"
+            f"upstream requests:  {report['upstream_requests']} ({report['upstream_failures']} failed on purpose)\n"
+            f"cache hit ratio:    {report['cache_hit_ratio']:.3f}")
@@ -0,0 +1,96 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/). All Rights Reserved.
+# Memory regression check, which measures the peak memory allocated by representative calls with tracemalloc
+# and fails if any of them go over their budget
+# Run it with: python -m CovidParser memcheck
+
+import json  # Used for decoding the baseline connector
+import threading  # Used for running the simulated upstream
+import tracemalloc  # Used for measuring allocations
+
+from . import CovidParser
+from .loadtest import SimulatedUpstreamV3
+
+# Number of days of simulated data to measure with
+MEMCHECK_DAYS_V3 = 600
+# Connector whose decoding is measured as the baseline that the budgets are relative to
+MEMCHECK_BASELINE_CONNECTOR_V3 = '0b334273-5661-4837-a639-e3a384d81d20'
+# Calls to measure, as (name, method, arguments, budget, budget after a refresh)
+# The budgets are fractions of the baseline, which is the peak allocation of decoding the whole main connector with
+# json.loads on the interpreter running the check, so they follow the size of objects on each Python version. They
+# have about 25% headroom over the peaks measured on CPython 3.11. Each call is measured twice with the data already
+# downloaded: once warm (with the tables it uses already decoded), which covers its parsing and output, and once
+# straight after a refresh (with nothing decoded yet), which also covers decoding
+MEMCHECK_CASES_V3 = [
+    ('new state cases all', 'new',
+     {'location': 'vic', 'data_type': 'cases', 'date_range': {'type': 'all'}}, 0.08, 0.58),
+    ('new state cases all with dates', 'new',
+     {'location': 'vic', 'data_type': 'cases', 'date_range': {'type': 'all'}, 'include_date': True}, 0.24, 0.74),
+    ('new national cases all', 'new',
+     {'location': 'aus', 'data_type': 'cases', 'date_range': {'type': 'all'}}, 0.08, 0.25),
+    ('new state recoveries all', 'new',
+     {'location': 'vic', 'data_type': 'recoveries', 'date_range': {'type': 'all'}}, 0.12, 0.31),
+    ('new country cases all', 'new',
+     {'location': 'germany', 'data_type': 'cases', 'date_range': {'type': 'all'}}, 0.08, 0.14),
+    ('new state cases native', 'new',
+     {'location': 'vic', 'data_type': 'cases', 'date_range': {'type': 'all'}, 'native': True}, 0.02, 0.52),
+    ('new_matrix cases all', 'new_matrix',
+     {'data_type': 'cases', 'date_range': {'type': 'all'}}, 0.78, 1.28),
+    ('total state cases', 'total',
+     {'location': 'vic', 'data_type': 'cases', 'date_range': {'type': 'all'}}, 0.08, 0.58),
+    ('total country cases', 'total',
+     {'location': 'germany', 'data_type': 'cases', 'date_range': {'type': 'all'}}, 0.08, 0.14),
+]
+
+
+# Function to measure each of the calls, returning a list of (name, peak bytes, budget in bytes)
+def run_memcheck(days=MEMCHECK_DAYS_V3):
+    upstream = SimulatedUpstreamV3(days=days)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    covid = CovidParser(cache_type=1, cache_update_interval=1000000, upstream_overrides=upstream.overrides())
+    results = []
+    try:
+        baseline = _measure_baseline_v3(upstream)
+        for name, method, arguments, budget, refresh_budget in MEMCHECK_CASES_V3:
+            # Download the data first, so that only the call itself is measured
+            getattr(covid, method)(**arguments)
+            results.append((name, _measure_v3(covid, name, method, arguments), int(budget * baseline)))
+            # Forget the parsed data, as a refresh of the downloaded data does
+            covid.parsed_cache_v3.clear()
+            results.append((f'{name} after refresh', _measure_v3(covid, name, method, arguments),
+                            int(refresh_budget * baseline)))
+    finally:
+        upstream.shutdown()
+        upstream.server_close()
+    return results
+
+
+# Function to return the peak memory allocated by decoding the baseline connector
+def _measure_baseline_v3(upstream: SimulatedUpstreamV3) -> int:
+    text = upstream.connectors[MEMCHECK_BASELINE_CONNECTOR_V3].decode('utf-8')
+    tracemalloc.start()
+    try:
+        json.loads(text)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+# Function to return the peak memory allocated by one call
+def _measure_v3(covid: CovidParser, name: str, method: str, arguments: dict) -> int:
+    tracemalloc.start()
+    try:
+        out = getattr(covid, method)(**arguments)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    if out['status'] != 'ok':
+        raise RuntimeError(f'{name} failed: {out}')
+    return peak
+
+
+def format_memcheck(results) -> str:
+    lines = []
+    for name, peak, budget in results:
+        lines.append(f"{'FAIL' if peak > budget else 'ok':4}  {name:44} peak {peak:>9} bytes  (budget {budget})")
+    return '\n'.join(lines)
@@ -0,0 +1,225 @@
+# Copyright (C) 2021 Alex Verrico (https://alexverrico.com/). All Rights Reserved.
+# HTTP service which exposes CovidParser.new(), CovidParser.new_matrix() and CovidParser.total() as JSON endpoints
+# Start it with: python -m CovidParser serve --port 8080
+# Then query it with e.g. GET /new?location=vic&data_type=cases&date_range=days:2&include_date=1
+
+import asyncio  # Used for serving many connections from one thread
+import json  # Used for exporting data
+from hashlib import sha1  # Used for building ETags from the response body
+from time import time  # Used for expiring cached responses
+from urllib.parse import urlsplit, parse_qsl  # Used for parsing request paths
+from concurrent.futures import ThreadPoolExecutor  # Used for running CovidParser calls off the event loop
+
+from . import CovidParser
+
+# Seconds to wait for a client to send its request
+REQUEST_TIMEOUT_V3 = 30
+# Largest request (request line and headers) that is accepted
+MAX_REQUEST_SIZE_V3 = 16384
+HTTP_REASONS_V3 = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                   413: 'Payload Too Large', 500: 'Internal Server Error'}
+# Paths of the endpoints, and the query parameters each one uses with their defaults
+ENDPOINTS_V3 = ('/new', '/matrix', '/total')
+ENDPOINT_PARAMS_V3 = {
+    '/new': {'location': 'aus', 'data_type': 'cases', 'date_range': 'days:2', 'include_date': '0'},
+    '/matrix': {'data_type': 'cases', 'date_range': 'days:2', 'include_national': '0'},
+    '/total': {'location': 'aus', 'data_type': 'cases', 'date_range': 'days:2'}
+}
+# Largest number of serialized responses that are kept
+MAX_RESPONSES_V3 = 1024
+
+
+# Function to convert a date_range query parameter ("all" or "days:<number>") to a DateRangeTypeV3
+# Raises ValueError for anything else
+def _parse_date_range_v3(value: str):
+    if value is None:
+        return None
+    parts = value.split(':')
+    if parts == ['all']:
+        return {'type': 'all'}
+    if len(parts) == 2 and parts[0] == 'days' and parts[1].isdigit():
+        return {'type': 'days', 'value': int(parts[1])}
+    raise ValueError(f'Unsupported date_range {value}')
+
+
+# Function to reduce the query parameters of a request to the ones its endpoint uses, in one form, so that requests
+# for the same data share a cached response. Raises ValueError for an unsupported date_range
+def _normalise_params_v3(path: str, params: dict) -> dict:
+    out = {}
+    for name, default in ENDPOINT_PARAMS_V3[path].items():
+        value = params.get(name, default).lower()
+        if name == 'date_range':
+            _parse_date_range_v3(value)
+            value = 'all' if value == 'all' else f"days:{int(value.split(':')[1])}"
+        elif name.startswith('include_'):
+            value = '1' if _parse_bool_v3(value) else '0'
+        out[name] = value
+    return out
+
+
+# Function to build the body of an error response, in the standard output format
+def _error_body_v3(message: str) -> bytes:
+    return json.dumps({'status': 'error', 'content': message, 'classified': 0}).encode('utf-8')
+
+
+def _parse_bool_v3(value: str) -> bool:
+    return value is not None and value.lower() in ('1', 'true', 'yes', 'y')
+
+
+class CovidServerV3:
+    def __init__(self, cache_type=2, cache_update_interval=300, log_file=None, cache_socket=None,
+                 response_ttl=5, workers=8, scheduler=None, max_responses=MAX_RESPONSES_V3):
+        # One CovidParser object, and so one warm cache, for every request
+        self.covid = CovidParser(cache_type=cache_type, cache_update_interval=cache_update_interval,
+                                 log_file=log_file, cache_socket=cache_socket, shared_cache=True, scheduler=scheduler)
+        # Seconds that a serialized response is reused for before asking the CovidParser object again
+        self.response_ttl = response_ttl
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Dictionary of {(path, query): (expiry timestamp, body, etag)}, oldest first
+        # Every response is kept for the same time, so the oldest responses are also the first to expire
+        self.responses = {}
+        self.max_responses = max_responses
+        # Dictionary of {(path, query): future} for responses which are being built, so they are only built once
+        self.pending = {}
+        return
+
+    # Function to call the CovidParser object for an endpoint, returning the output as a dictionary
+    def query(self, path: str, params: dict) -> dict:
+        if path == '/new':
+            return self.covid.new(location=params.get('location', 'aus'), data_type=params.get('data_type', 'cases'),
+                                  date_range=_parse_date_range_v3(params.get('date_range')),
+                                  include_date=_parse_bool_v3(params.get('include_date')))
+        elif path == '/matrix':
+            return self.covid.new_matrix(data_type=params.get('data_type', 'cases'),
+                                         date_range=_parse_date_range_v3(params.get('date_range')),
+                                         include_national=_parse_bool_v3(params.get('include_national')))
+        elif path == '/total':
+            return self.covid.total(location=params.get('location', 'aus'), data_type=params.get('data_type', 'cases'),
+                                    date_range=_parse_date_range_v3(params.get('date_range')))
+        raise ValueError(f'Unknown endpoint {path}')
+
+    # Function to return the serialized body and ETag for a request, building it if it isn't cached
+    async def response(self, path: str, params: dict):
+        params = _normalise_params_v3(path, params)
+        key = (path, tuple(sorted(params.items())))
+        cached = self.responses.get(key)
+        if cached is not None:
+            if cached[0] > time():
+                return cached[1], cached[2]
+            del self.responses[key]
+        # If another connection is already building this response, then wait for it instead of building it again
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            out = await asyncio.get_running_loop().run_in_executor(self.executor, self.query, path, params)
+            body = json.dumps(out).encode('utf-8')
+            # The ETag is a version of the payload, so it only changes when the data does
+            etag = f'"{sha1(body).hexdigest()[:20]}"'
+            # Don't keep errors, so the next request tries again
+            if out.get('status') == 'ok' and not out.get('stale'):
+                self.store(key, body, etag)
+            future.set_result((body, etag))
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved, in case nothing else was waiting for it
+            future.exception()
+            raise
+        finally:
+            del self.pending[key]
+        return body, etag
+
+    # Function to keep a serialized response, dropping expired responses and then the oldest ones over the limit
+    def store(self, key, body: bytes, etag: str):
+        self.responses.pop(key, None)
+        now = time()
+        while len(self.responses) > 0:
+            oldest = next(iter(self.responses))
+            if self.responses[oldest][0] > now and len(self.responses) < self.max_responses:
+                break
+            del self.responses[oldest]
+        self.responses[key] = (now + self.response_ttl, body, etag)
+        return
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT_V3)
+                except asyncio.LimitOverrunError:
+                    await self.send(writer, 413, _error_body_v3('Request too large'))
+                    return
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                lines = request.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = lines[0].split(' ')
+                except ValueError:
+                    await self.send(writer, 400, _error_body_v3('Bad request'))
+                    return
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+                if method != 'GET':
+                    await self.send(writer, 405, _error_body_v3('Method not allowed'),
+                                    keep_alive=keep_alive)
+                elif urlsplit(target).path not in ENDPOINTS_V3:
+                    await self.send(writer, 404, _error_body_v3('Not found'),
+                                    keep_alive=keep_alive)
+                else:
+                    target = urlsplit(target)
+                    params = dict(parse_qsl(target.query))
+                    try:
+                        body, etag = await self.response(target.path, params)
+                    except (ValueError, TypeError, IndexError):
+                        await self.send(writer, 400, _error_body_v3('Bad request'),
+                                        keep_alive=keep_alive)
+                    except Exception as e:
+                        self.covid.print(f"Error in CovidServerV3 for {target.path}?{target.query} ({repr(e)})")
+                        await self.send(writer, 500, _error_body_v3('Internal error'),
+                                        keep_alive=keep_alive)
+                    else:
+                        if headers.get('if-none-match') == etag:
+                            await self.send(writer, 304, b'', etag=etag, keep_alive=keep_alive)
+                        else:
+                            await self.send(writer, 200, body, etag=etag, keep_alive=keep_alive)
+                if not keep_alive:
+                    return
+        finally:
+            writer.close()
+
+    async def send(self, writer, status: int, body: bytes, etag: str = None, keep_alive: bool = False):
+        headers = [f'HTTP/1.1 {status} {HTTP_REASONS_V3[status]}']
+        if status != 304:
+            headers.append('Content-Type: application/json')
+            headers.append(f'Content-Length: {len(body)}')
+        if etag is not None:
+            headers.append(f'ETag: {etag}')
+            headers.append(f'Cache-Control: max-age={self.response_ttl}')
+        headers.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+        return
+
+    async def serve_forever(self, host: str = '127.0.0.1', port: int = 8080):
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_REQUEST_SIZE_V3)
+        async with server:
+            await server.serve_forever()
+        return
+
+
+def serve(host='127.0.0.1', port=8080, cache_type=2, cache_update_interval=300, log_file=None, cache_socket=None,
+          response_ttl=5, workers=8, scheduler=None, max_responses=MAX_RESPONSES_V3):
+    server = CovidServerV3(cache_type=cache_type, cache_update_interval=cache_update_interval, log_file=log_file,
+                           cache_socket=cache_socket, response_ttl=response_ttl, workers=workers, scheduler=scheduler,
+                           max_responses=max_responses)
+    try:
+        asyncio.run(server.serve_forever(host, port))
+    except KeyboardInterrupt:
+        pass
+    return